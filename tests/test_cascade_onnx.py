@@ -0,0 +1,59 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# import cascade2p on its own: importing the vineseg package sets up the Windows app
+# and downloads models
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'vineseg'))
+from cascade2p import cascade  # noqa: E402
+from cascade2p import onnx_models  # noqa: E402
+
+
+def _keras_model(window=64):
+    from tensorflow.keras.layers import Conv1D, Dense, Flatten, Input
+    from tensorflow.keras.models import Model
+
+    inputs = Input(shape=(window, 1))
+    x = Conv1D(8, 5, activation='relu')(inputs)
+    x = Flatten()(x)
+    x = Dense(16, activation='relu')(x)
+    outputs = Dense(1, activation='linear')(x)
+    return Model(inputs, outputs)
+
+
+def test_onnx_matches_keras(tmp_path):
+    pytest.importorskip('tensorflow')
+    pytest.importorskip('onnxruntime')
+    pytest.importorskip('tf2onnx')
+    from tensorflow.keras.models import load_model
+
+    model_file = str(tmp_path / 'Model_NoiseLevel_2_Ensemble_0.h5')
+    _keras_model().save(model_file)
+
+    assert not onnx_models.is_folder_converted(str(tmp_path))
+    onnx_models.convert_model_folder(str(tmp_path))
+    assert onnx_models.is_folder_converted(str(tmp_path))
+    assert onnx_models.onnx_available(os.path.dirname(str(tmp_path)))
+
+    X = np.random.RandomState(0).randn(200, 64, 1).astype(np.float32)
+    expected = load_model(model_file).predict(X, batch_size=64)
+    actual = onnx_models.load_model(model_file).predict(X, batch_size=64)
+
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_select_backend(tmp_path):
+    # an unconverted model folder can only be run with TensorFlow
+    open(str(tmp_path / 'Model_NoiseLevel_2_Ensemble_0.h5'), 'w').close()
+    assert not onnx_models.is_folder_converted(str(tmp_path))
+
+    try:
+        import tensorflow  # noqa: F401
+        expected = 'keras'
+    except ImportError:
+        expected = None
+    assert cascade.select_backend('auto', str(tmp_path)) == expected
+    assert cascade.select_backend('onnx', str(tmp_path)) == 'onnx'
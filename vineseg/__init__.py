@@ -46,16 +46,12 @@ import urllib.request
 default_url = "http://vineseg.isyn-mainz.de/"
 has_a_model = False
 
-try:
-    from tensorflow.version import VERSION
-
-    cascade_enabled = True
-except ImportError:
-    cascade_enabled = False
-
-
 # check if local manifest file exists
 script_dir = os.path.dirname(__file__)
+
+# CASCADE runs with TensorFlow or, without it, with onnxruntime on converted models
+from .cascade2p.cascade import backend_available
+cascade_enabled = backend_available('auto', os.path.join(script_dir, "CASCADE_models"))
 manifest_path = os.path.join(script_dir, "experiments/MANIFEST.json")
 manifest_path_cascade = os.path.join(script_dir, "CASCADE_models/MANIFEST.json")
 if os.path.isfile(manifest_path):
@@ -0,0 +1,107 @@
+from itertools import islice
+
+import numpy as np
+from PIL import Image
+from shapely.geometry import Polygon
+from shapely.strtree import STRtree
+
+
+def tile_origins(length, tile_size, overlap):
+    """Offsets of the tiles along one image axis; neighbouring tiles share at
+    least `overlap` pixels and the last tile ends at the image border."""
+    if length <= tile_size:
+        return [0]
+    stride = max(tile_size - overlap, 1)
+    origins = list(range(0, length - tile_size, stride))
+    origins.append(length - tile_size)
+    return origins
+
+
+def iter_tiles(image, tile_size, overlap):
+    """Yield (x, y, tile) for all tiles of an image array; tiles are views."""
+    height, width = image.shape[:2]
+    for y in tile_origins(height, tile_size, overlap):
+        for x in tile_origins(width, tile_size, overlap):
+            yield x, y, image[y:y + tile_size, x:x + tile_size]
+
+
+def touches_inner_border(points, x, y, tile_shape, image_shape, margin=2):
+    """True if the polygon (tile coordinates) reaches a tile border that is not
+    an image border, i.e. the object is probably cut by the tile."""
+    tile_height, tile_width = tile_shape[:2]
+    height, width = image_shape[:2]
+    x_min, y_min = points.min(axis=0)
+    x_max, y_max = points.max(axis=0)
+    return bool(
+        (x > 0 and x_min <= margin)
+        or (y > 0 and y_min <= margin)
+        or (x + tile_width < width and x_max >= tile_width - 1 - margin)
+        or (y + tile_height < height and y_max >= tile_height - 1 - margin)
+    )
+
+
+def merge_detections(detections, iou_threshold=0.5):
+    """Non-maximum suppression of (points, score) detections by the IoU of
+    their polygons. Candidate pairs come from a spatial index, so only
+    overlapping polygons are compared."""
+    if not detections:
+        return []
+
+    polygons = []
+    for points, _ in detections:
+        polygon = Polygon(points)
+        if not polygon.is_valid:
+            polygon = polygon.buffer(0)
+        polygons.append(polygon)
+    tree = STRtree(polygons)
+
+    order = np.argsort([-score for _, score in detections], kind="stable")
+    suppressed = np.zeros(len(detections), dtype=bool)
+    keep = []
+    for i in order:
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        for j in tree.query(polygons[i]):
+            if j == i or suppressed[j]:
+                continue
+            union = polygons[i].union(polygons[j]).area
+            if union > 0 and polygons[i].intersection(polygons[j]).area / union > iou_threshold:
+                suppressed[j] = True
+    return [detections[i] for i in sorted(keep)]
+
+
+def predict_tiles(model, image, tile_size=640, overlap=128, batch_size=8, conf=0.1, iou_threshold=0.5):
+    """Segment a large image tile by tile at the native resolution of the model.
+
+    Tiles of tile_size pixels, overlapping by `overlap` pixels, are passed to
+    the model in batches of batch_size, so memory is bounded by the batch and
+    not by the image. Objects cut by an inner tile border are dropped, as the
+    neighbouring tile contains them completely (overlap has to be larger than
+    the largest object). Duplicates from overlapping tiles are merged with
+    merge_detections().
+
+    Returns a list of (points, score) with points in image coordinates.
+    """
+    image = np.asarray(image)
+    if image.ndim == 2:
+        image = np.stack([image] * 3, axis=-1)
+
+    detections = []
+    tiles = iter_tiles(image, tile_size, overlap)
+    while True:
+        batch = list(islice(tiles, batch_size))
+        if not batch:
+            break
+
+        results = model.predict([Image.fromarray(tile) for _, _, tile in batch], conf=conf, imgsz=tile_size)
+        for (x, y, tile), result in zip(batch, results):
+            if result.masks is None:
+                continue
+            for points, score in zip(result.masks.xy, result.boxes.conf):
+                points = np.asarray(points, dtype=float).reshape(-1, 2)
+                if len(points) < 3 or touches_inner_border(points, x, y, tile.shape, image.shape):
+                    continue
+                detections.append((points + (x, y), float(score)))
+
+    return merge_detections(detections, iou_threshold)
@@ -1,58 +1,300 @@
-import matplotlib.pyplot as plt
+import base64
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from shapely.geometry import Polygon
+from PIL import Image
 
+from .tiling import predict_tiles
 from .vine_seg import ViNeSeg
 
+# number of loaded models that are kept for later predictions
+MAX_MODELS = 2
+
+# loaded models by (weights path, modification time), least recently used first
+_models = OrderedDict()
+
+
+def get_model(model_path):
+    """Return a loaded model for the weights file, loading it only if it is not
+    loaded yet or if the file changed since it was loaded."""
+    model_path = os.path.abspath(model_path)
+    key = (model_path, os.path.getmtime(model_path))
+
+    model = _models.pop(key, None)
+    if model is None:
+        # drop models loaded from an older version of the same file
+        for old_key in [k for k in _models if k[0] == model_path]:
+            del _models[old_key]
+        model = ViNeSeg(model_path)
+    _models[key] = model
+
+    while len(_models) > MAX_MODELS:
+        _models.popitem(last=False)
+    return model
+
 
-def predict(image_path, model_path, conf_threshold=0.1, plot_first=True):
-    model = ViNeSeg(model_path)
+def clear_models():
+    _models.clear()
+
+
+def predict(image_path, model_path, conf_threshold=0.1, plot_first=False):
+    model = get_model(model_path)
     result = model.predict(image_path, conf=conf_threshold)
     if plot_first:
+        # debugging only, the GUI does not show this plot
+        import matplotlib.pyplot as plt
+
         first_result = result[0]
         plt.imshow(first_result.plot())
 
     return result
 
 
-def parse_mask_to_vineseg(mask):
-    # assuming only a single image has been predicted
-    mask = np.array(mask.xy).squeeze()
+def predict_tiled(image, model_path, tile_size=640, overlap=128, batch_size=8, conf_threshold=0.1,
+                  min_size=1, max_size=1000, tolerance=0.0):
+    """Segment a large image in overlapping tiles at the native resolution of
+    the model (see tiling.predict_tiles) and return its shapes. The image is
+    a file path or an image that is already in memory (PIL image or array)."""
+    if isinstance(image, str):
+        image = load_image(image)
+    detections = predict_tiles(get_model(model_path), image, tile_size=tile_size,
+                               overlap=overlap, batch_size=batch_size, conf=conf_threshold)
+    return contours_to_vineseg([points for points, _ in detections], [score for _, score in detections],
+                               min_size=min_size, max_size=max_size, tolerance=tolerance)
+
+
+def polygon_areas(contours):
+    """Areas of many polygons at once, with the shoelace formula over all
+    vertices. Contours with less than 3 vertices have area 0."""
+    counts = np.array([len(contour) for contour in contours], dtype=int)
+    areas = np.zeros(len(contours))
+    valid = counts >= 3
+    if not valid.any():
+        return areas
+
+    points = np.concatenate([contour for contour, ok in zip(contours, valid) if ok])
+    ends = np.cumsum(counts[valid])
+    starts = ends - counts[valid]
 
-    # Get the x and y coordinates of the contour
-    x_coords, y_coords = mask[:, 0], mask[:, 1]
-    # Create a list of (x, y) tuples for the polygon vertices
-    polygon_vertices = [coord for coord in zip(x_coords, y_coords)]
-    # Create a Shapely Polygon from the vertices
-    polygon = Polygon(polygon_vertices)
-    # Simplify the polygon using the Ramer-Douglas-Peucker algorithm
-    simplified_polygon = polygon.simplify(tolerance=0.0)
-    simplified_polygon_coords = list(simplified_polygon.exterior.coords)
-    simplified_polygon_area = simplified_polygon.area
+    # index of the next vertex, wrapping around within each polygon
+    following = np.arange(1, len(points) + 1)
+    following[ends - 1] = starts
+    x, y = points[:, 0], points[:, 1]
+    cross = x * y[following] - x[following] * y
 
-    return simplified_polygon_coords, simplified_polygon_area
+    areas[valid] = np.abs(np.add.reduceat(cross, starts)) / 2
+    return areas
 
 
-def get_vineseg_list(predictions, min_size=1, max_size=1000, conf_threshold=0.1):
+def simplify_contours(contours, tolerance):
+    """Douglas-Peucker simplification of many contours at once. Contours that
+    would collapse to less than 3 vertices are kept unchanged."""
+    import shapely
+
+    simplified = list(contours)
+    index = [i for i, contour in enumerate(contours) if len(contour) >= 3]
+    if not index:
+        return simplified
+
+    counts = [len(contours[i]) for i in index]
+    rings = shapely.linearrings(np.concatenate([contours[i] for i in index]),
+                                indices=np.repeat(np.arange(len(index)), counts))
+    polygons = shapely.simplify(shapely.polygons(rings), tolerance, preserve_topology=False)
+
+    coords, owner = shapely.get_coordinates(polygons, return_index=True)
+    pieces = np.split(coords, np.cumsum(np.bincount(owner, minlength=len(index)))[:-1])
+    for i, piece in zip(index, pieces):
+        # rings are closed, the label file stores open polygons
+        if len(piece) - 1 >= 3:
+            simplified[i] = piece[:-1]
+    return simplified
+
+
+def contours_to_vineseg(contours, scores, min_size=1, max_size=1000, tolerance=0.0):
+    """Shapes of the label file for contours (arrays of x, y vertices) and
+    their scores. The contours are simplified with the Douglas-Peucker
+    tolerance in pixels (0: unchanged) and labelled by their area."""
+    contours = [np.asarray(contour, dtype=float).reshape(-1, 2) for contour in contours]
+    if tolerance > 0:
+        contours = simplify_contours(contours, tolerance)
+
+    areas = polygon_areas(contours)
+    labels = np.where(areas < min_size, "Neuron_too_small", np.where(areas > max_size, "Neuron_too_big", "Neuron"))
+
+    return [
+        {
+            "shape_type": 'polygon',
+            "points": contour.tolist(),
+            "score": float(score),
+            "label": str(label),
+        }
+        for contour, score, label in zip(contours, scores, labels)
+    ]
+
+
+def parse_mask_to_vineseg(mask, tolerance=0.0):
+    # assuming only a single image has been predicted
+    contour = np.asarray(mask.xy[0], dtype=float).reshape(-1, 2)
+    if tolerance > 0:
+        contour = simplify_contours([contour], tolerance)[0]
+    return [tuple(point) for point in contour], polygon_areas([contour])[0]
+
+
+def get_vineseg_list(predictions, min_size=1, max_size=1000, conf_threshold=0.1, tolerance=0.0):
     result = []
     # in case there are multiple predictions at the same time
     for pred in predictions:
-        scores = pred.boxes.conf
-        path = pred.path
-        try:
-            for idx, mask in enumerate(pred.masks):
-                coords, area = parse_mask_to_vineseg(mask)
-                score = scores[idx]
-                points = np.array(mask.xy).squeeze().tolist()
-                label = "Neuron_too_small" if area < min_size else "Neuron_too_big" if area > max_size else "Neuron"
-                result.append(
-                    {
-                        "shape_type": 'polygon',
-                        "points": points,
-                        "score": score.item(),
-                        "label": label,
-                    }
-                )
-        except TypeError:
+        if pred.masks is None:
             print("No ROIs found. Try another model or adapt the minimum/maximum size for expected neurons.")
+            continue
+        result.extend(contours_to_vineseg(pred.masks.xy, pred.boxes.conf.tolist(),
+                                          min_size=min_size, max_size=max_size, tolerance=tolerance))
     return result
+
+
+IMAGE_EXTENSIONS = (".png", ".tif", ".tiff")
+
+
+def list_images(source):
+    """Image files to segment: the images in a directory, or the given list of files."""
+    if isinstance(source, str) and os.path.isdir(source):
+        return sorted(
+            os.path.join(source, name)
+            for name in os.listdir(source)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+    return list(source)
+
+
+def to_uint8(image):
+    """8-bit version of a high bit depth image array. Integer images keep their
+    upper 8 bits, as when ultralytics (OpenCV) reads the file itself, so that an
+    image gives the same prediction from memory and from its path; float images
+    are scaled from their minimum and maximum."""
+    image = np.asarray(image)
+    if image.dtype == np.uint8:
+        return image
+    if np.issubdtype(image.dtype, np.integer):
+        shift = 8 * (image.dtype.itemsize - 1)
+        return (np.clip(image, 0, None).astype(np.uint64) >> shift).astype(np.uint8)
+    image = np.nan_to_num(image.astype(np.float64))
+    low, high = image.min(), image.max()
+    if high <= low:
+        return np.zeros(image.shape, dtype=np.uint8)
+    return np.round((image - low) / (high - low) * 255).astype(np.uint8)
+
+
+def label_file_path(image_path, output_dir=None):
+    """Label file of an image: next to the image, or in output_dir if given."""
+    json_path = os.path.splitext(image_path)[0] + ".json"
+    if output_dir is not None:
+        json_path = os.path.join(output_dir, os.path.basename(json_path))
+    return json_path
+
+
+def load_image(image_path):
+    """Load an image as 8-bit RGB; 16 bit and float images are reduced with
+    to_uint8() instead of being clipped by PIL."""
+    with Image.open(image_path) as image:
+        if image.mode in ("I", "I;16", "I;16B", "I;16L", "F"):
+            array = np.array(image)
+            # PIL opens 16 bit PNGs as 32 bit integers
+            if image.mode == "I" and array.size and array.min() >= 0 and array.max() < 2 ** 16:
+                array = array.astype(np.uint16)
+            image = Image.fromarray(to_uint8(array))
+        return image.convert("RGB")
+
+
+def write_label_file(json_path, image_path, shapes, image_size, embed_image=True):
+    """Write shapes of one image in the label file format of the GUI."""
+    image_data = None
+    if embed_image:
+        with open(image_path, "rb") as f:
+            image_data = base64.b64encode(f.read()).decode("utf-8")
+
+    try:
+        image_path = os.path.relpath(image_path, os.path.dirname(os.path.abspath(json_path)))
+    except ValueError:
+        # different drives on Windows
+        image_path = os.path.abspath(image_path)
+
+    width, height = image_size
+    json_out = {
+        "version": "4.5.13",
+        "flags": {},
+        "shapes": shapes,
+        "imagePath": image_path,
+        "imageData": image_data,
+        "imageHeight": height,
+        "imageWidth": width,
+    }
+
+    # write next to the target first, so that an interrupted run leaves no partial label file
+    with open(json_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(json_out, f)
+    os.replace(json_path + ".tmp", json_path)
+    return json_path
+
+
+def segment_images(source, model_path, output_dir=None, batch_size=8, conf_threshold=0.1,
+                   min_size=1, max_size=1000, workers=4, embed_image=True, progress=None, cancelled=None,
+                   tile_size=None, overlap=128, tolerance=0.0, overwrite=False):
+    """Segment all images of a directory or list of files and write one label file per image.
+
+    Images are passed to the model in batches of batch_size. A thread pool loads the next
+    batch and writes the label files of the previous one while the model predicts.
+    Label files are written to output_dir, or next to the images if output_dir is None
+    (see label_file_path). Images that already have a label file are skipped, so that
+    edited labels are not lost, unless overwrite is True.
+    With tile_size, each image is segmented in overlapping tiles (see predict_tiled),
+    and the batches consist of the tiles of one image. Polygons are simplified with
+    the Douglas-Peucker tolerance in pixels (0: unchanged).
+    progress(done, total) is called after each batch; if cancelled() returns True, no
+    further batches are started.
+
+    Returns the paths of the written label files.
+    """
+    image_paths = list_images(source)
+    if not overwrite:
+        image_paths = [path for path in image_paths if not os.path.exists(label_file_path(path, output_dir))]
+    batches = [image_paths[i:i + batch_size] for i in range(0, len(image_paths), batch_size)]
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    model = get_model(model_path)
+    writes = []
+
+    with ThreadPoolExecutor(workers) as pool:
+        loading = [pool.submit(load_image, path) for path in batches[0]] if batches else []
+
+        for i, batch in enumerate(batches):
+            if cancelled is not None and cancelled():
+                break
+
+            images = [future.result() for future in loading]
+            if i + 1 < len(batches):
+                loading = [pool.submit(load_image, path) for path in batches[i + 1]]
+
+            if tile_size:
+                shapes_list = []
+                for image in images:
+                    detections = predict_tiles(model, image, tile_size=tile_size, overlap=overlap,
+                                               batch_size=batch_size, conf=conf_threshold)
+                    shapes_list.append(contours_to_vineseg(
+                        [points for points, _ in detections], [score for _, score in detections],
+                        min_size=min_size, max_size=max_size, tolerance=tolerance))
+            else:
+                shapes_list = [get_vineseg_list([result], min_size=min_size, max_size=max_size, tolerance=tolerance)
+                               for result in model.predict(images, conf=conf_threshold)]
+
+            for image_path, image, shapes in zip(batch, images, shapes_list):
+                json_path = label_file_path(image_path, output_dir)
+                writes.append(pool.submit(write_label_file, json_path, image_path, shapes, image.size, embed_image))
+
+            if progress is not None:
+                progress(min((i + 1) * batch_size, len(image_paths)), len(image_paths))
+
+        return [future.result() for future in writes]
@@ -34,7 +34,10 @@ class ViNeSeg:
         show: bool = False,
         show_labels: bool = False,
         show_conf: bool = False,
+        imgsz: int = None,
     ):
+        # imgsz: input size of the network, default: the size used for training
+        options = {} if imgsz is None else {"imgsz": imgsz}
         result = self.model.predict(
             source=source,
             conf=conf,
@@ -42,5 +45,6 @@ class ViNeSeg:
             show=show,
             show_labels=show_labels,
             show_conf=show_conf,
+            **options,
         )
         return result
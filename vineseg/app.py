@@ -10,7 +10,6 @@ import json
 import webbrowser
 from PIL import Image, ImageEnhance
 import imageio
-import pandas as pd
 import tifffile as tfile
 
 import imgviz
@@ -40,18 +39,18 @@ from .widgets import UniqueLabelQListWidget
 from .widgets import ZoomWidget
 from shapely.geometry import Polygon
 from .utils import shape_to_mask
-from .traces.tracemanager import tracesForImage, tracesForSlice
-from .traces.dff import dff_calc
+from .traces import tracemanager
+from .traces import pipeline
+from .traces.store import write_rois, rois_from_shapes, derived_path
 from .spike_detection import run_CASCADE
 from . import modelmanager
 from . import modelmanagerX
 from .cascade2p import checks
+from .cascade2p.cascade import backend_available, select_backend
 
-import sys
-from .ai_pipeline.vine_seg.utils import predict, get_vineseg_list
+from .ai_pipeline.vine_seg.utils import predict, predict_tiled, get_vineseg_list, segment_images, \
+    load_image, write_label_file, list_images, label_file_path
 
-from multiprocessing import Pool
-from itertools import repeat
 
 # FIXME
 # - [medium] Set max zoom value to something big enough for FitWidth/Window
@@ -61,6 +60,7 @@ from itertools import repeat
 
 
 LABEL_COLORMAP = imgviz.label_colormap()
+TRACE_FILE_FORMATS = "*.tsv *.h5 *.npy"
 currDirPath = ""
 
 
@@ -134,13 +134,11 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.labelList = LabelListWidget()
         self.lastOpenDir = None
-        try:
-            from tensorflow.version import VERSION
-            self.cascade_enabled = True
-        except ImportError:
+        self.cascade_enabled = backend_available(self._config["cascade_backend"],
+                                                 osp.join(osp.dirname(__file__), "CASCADE_models"))
+        if not self.cascade_enabled:
             print("Setup for CASCADE not given\nVisit our github documentary for "
                   "specifications about how to install ViNe-Seg with CASCADE.")
-            self.cascade_enabled = False
 
         self.flag_dock = self.flag_widget = None
         self.flag_dock = QtWidgets.QDockWidget(self.tr("Flags"), self)
@@ -532,6 +530,13 @@ class MainWindow(QtWidgets.QMainWindow):
             tip=self.tr("Run ViNe-Seg Segmentation Pipeline"),
         )
 
+        batchAutoseg = action(
+            self.tr("ViNe-Seg on &Directory"),
+            self.batchAutosegmentation,
+            icon="ViNeSeg",
+            tip=self.tr("Run ViNe-Seg on all images of a directory and save a label file for each"),
+        )
+
         micMode = action(
             self.tr("&Microscope Mode"),
             self.microscope,
@@ -866,6 +871,7 @@ class MainWindow(QtWidgets.QMainWindow):
             self.menus.autoseg,
             (
                 autoseg,
+                batchAutoseg,
                 None,
                 self.menus.allModels,
                 showmodelmanager,
@@ -1265,176 +1271,164 @@ class MainWindow(QtWidgets.QMainWindow):
         mbFormat.exec()
         self.actions.refresh.setEnabled(True)
 
-    def autosegmentation(self):
+    def batchAutosegmentation(self):
 
         if not self.mayContinue():
             return
 
-        sys.path.insert(0, './ai_pipeline')
-        # from .ai_pipeline.prediction import pred_main
-        # from .ai_pipeline.model import test
+        defaultOpenDirPath = self.lastOpenDir if self.lastOpenDir and osp.exists(self.lastOpenDir) else "."
+        targetDirPath = str(
+            QtWidgets.QFileDialog.getExistingDirectory(
+                self,
+                self.tr("%s - Segment Directory") % __appname__,
+                defaultOpenDirPath,
+                QtWidgets.QFileDialog.ShowDirsOnly
+                | QtWidgets.QFileDialog.DontResolveSymlinks,
+            )
+        )
+        if not targetDirPath:
+            return
 
-        self.traceProgress = QtWidgets.QProgressDialog("Autosegmentation...", "cancel", 0, 100,
-                                                       self)
+        # existing label files may contain manual edits, they are only replaced after confirmation
+        existing = [path for path in list_images(targetDirPath)
+                    if osp.exists(label_file_path(path, self.output_dir))]
+        overwrite = False
+        if existing:
+            mb = QtWidgets.QMessageBox
+            answer = mb.question(self, self.tr("Existing label files"),
+                                 self.tr("%d images already have a label file. Overwrite them?\n"
+                                         "Choose 'No' to segment only the images without label file.")
+                                 % len(existing),
+                                 mb.Yes | mb.No | mb.Cancel, mb.No)
+            if answer == mb.Cancel:
+                return
+            overwrite = answer == mb.Yes
+
+        model_path = os.path.dirname(__file__).replace("\\", "/") + "/experiments/" + self.currentModel
+
+        self.traceProgress = QtWidgets.QProgressDialog("Autosegmentation of directory...", "Cancel", 0, 100, self)
         self.traceProgress.setWindowModality(Qt.WindowModal)
         self.traceProgress.forceShow()
         self.traceProgress.setValue(1)
 
-        if self.imagePath != None:
-
-            if not self.imagePath.endswith((".png", ".tiff", "tif")):
-                mbFormat = QtWidgets.QMessageBox(QtWidgets.QMessageBox.Warning, "Unsupported file format",
-                                                 "Please choose PNG, TIF or TIFF image file.",
-                                                 QtWidgets.QMessageBox.Ok)
-                mbFormat.exec()
-
-            elif self.brightnessContrast_values[self.filename] != (None, None):
-                img = Image.open(self.imagePath)
-                if self.imagePath.endswith(".tiff"):
-                    img.save(self.imagePath.replace(".tiff", ".png"))
-                    img = Image.open(self.imagePath.replace(".tiff", ".png"))
-                elif self.imagePath.endswith(".tif"):
-                    img.save(self.imagePath.replace(".tif", ".png"))
-                    img = Image.open(self.imagePath.replace(".tif", ".png"))
-
-                im_curr = ImageEnhance.Brightness(img).enhance(self.brightnessContrast_values[self.filename][0] / 50)
-                im_output = ImageEnhance.Contrast(im_curr).enhance(
-                    self.brightnessContrast_values[self.filename][1] / 50)
-                # tiff tif or PNG
-                if self.imagePath.endswith(".png"):
-                    im_output.save(osp.splitext(self.imagePath)[0] + "_b_{brightness}_c{contrast}.png".format(
-                        brightness=self.brightnessContrast_values[self.filename][0],
-                        contrast=self.brightnessContrast_values[self.filename][1]))
-                    self.imagePath = osp.splitext(self.imagePath)[0] + "_b_{brightness}_c{contrast}.png".format(
-                        brightness=self.brightnessContrast_values[self.filename][0],
-                        contrast=self.brightnessContrast_values[self.filename][1])
-                    self.loadFile(self.imagePath)
-                elif self.imagePath.endswith(".tiff"):
-                    im_output.save(osp.splitext(self.imagePath)[0] + "_b_{brightness}_c{contrast}.tiff".format(
-                        brightness=self.brightnessContrast_values[self.filename][0],
-                        contrast=self.brightnessContrast_values[self.filename][1]), quality=100)
-                    self.imagePath = osp.splitext(self.imagePath)[0] + + "_b_{brightness}_c{contrast}.tiff".format(
-                        brightness=self.brightnessContrast_values[self.filename][0],
-                        contrast=self.brightnessContrast_values[self.filename][1])
-                    self.loadFile(self.imagePath)
-                elif self.imagePath.endswith(".tif"):
-                    im_output.save(osp.splitext(self.imagePath)[0] + + "_b_{brightness}_c{contrast}.tif".format(
-                        brightness=self.brightnessContrast_values[self.filename][0],
-                        contrast=self.brightnessContrast_values[self.filename][1]), quality=100)
-                    self.imagePath = osp.splitext(self.imagePath)[0] + + "_b_{brightness}_c{contrast}.tif".format(
-                        brightness=self.brightnessContrast_values[self.filename][0],
-                        contrast=self.brightnessContrast_values[self.filename][1])
-                    self.loadFile(self.imagePath)
-
-        elif self.imagePath == None:
-            self.openFile()
-
-        if self.imagePath != None:
-            if not self.imagePath.endswith((".png", ".tiff", ".tif")):
-                mbFormat = QtWidgets.QMessageBox(QtWidgets.QMessageBox.Warning, "Unsupported file format",
-                                                 "Please choose PNG, TIF or TIFF image file.",
-                                                 QtWidgets.QMessageBox.Ok)
-                mbFormat.exec()
-
-            if self.imagePath.endswith((".png", ".tiff", "tif")):
-                im_path = self.imagePath.replace("\\", "/")
-                self.traceProgress.setValue(15)
-
-                image_path = self.imagePath
-                model_path = os.path.dirname(__file__).replace("\\", "/") + "/experiments/" + self.currentModel
-
-                print(image_path, model_path)
-
-                prediction_result = predict(image_path, model_path, plot_first=True)
-                if prediction_result[0].masks == None:
-                    vineseg_list = [{'shape_type': 'polygon', 'points': [], 'score': 0, 'label': 'Neuron'}]
-
-                    mbFormat = QtWidgets.QMessageBox(QtWidgets.QMessageBox.Warning, "No shapes detected by this model.",
-                                                     "Please try another model or adapt min/max size of neuronal bodies.",
-                                                     QtWidgets.QMessageBox.Ok)
-                    mbFormat.exec()
-
-                else:
-                    vineseg_list = get_vineseg_list(prediction_result, min_size=int(self.minMaxNeuronValues[0] // 2),
-                                                    max_size=int(self.minMaxNeuronValues[1] * 2))
-                import base64
-
-                def image_to_base64(image_path):
-                    with open(image_path, "rb") as image_file:
-                        # Read the file
-                        data = image_file.read()
-
-                        # Encode as base64
-                        encoded = base64.b64encode(data)
-                        return encoded.decode('utf-8')
-
-                imageData = image_to_base64(image_path)
-                # print("imageData", imageData)
-
-                json_out = {"version": "4.5.13", "flags": {}, "shapes": vineseg_list, "imagePath": image_path,
-                            "imageData": imageData, "imageHeight": utils.img_b64_to_arr(imageData).shape[0],
-                            "imageWidth": utils.img_b64_to_arr(imageData).shape[1]}
-                # print(json_out)
-
-                import shutil
-                # Step 1: Get the current module's directory
-                vineseg_dir = os.path.dirname(__file__)
-
-                # Step 2: Create 'data' directory
-                data_dir = os.path.join(vineseg_dir, 'data')
-                os.makedirs(data_dir, exist_ok=True)
-
-                # Step 3: Copy the current image to the 'data' directory
-                new_image_path = os.path.join(data_dir, os.path.basename(self.imagePath))
+        def progress(done, total):
+            self.traceProgress.setValue(int(done / total * 99) + 1)
+
+        # label files go next to the images, or to the chosen annotation directory
+        labelFiles = segment_images(targetDirPath, model_path, output_dir=self.output_dir,
+                                    min_size=int(self.minMaxNeuronValues[0] // 2),
+                                    max_size=int(self.minMaxNeuronValues[1] * 2),
+                                    progress=progress, cancelled=self.traceProgress.wasCanceled,
+                                    tile_size=self._config["autoseg_tile_size"],
+                                    overlap=self._config["autoseg_tile_overlap"],
+                                    tolerance=self._config["autoseg_simplify_tolerance"],
+                                    overwrite=overwrite)
+        self.traceProgress.close()
 
-                if self.imagePath.replace("\\", "/") != new_image_path.replace("\\", "/"):
-                    shutil.copy(self.imagePath, new_image_path)
+        message = "{} label files written.".format(len(labelFiles))
+        if existing and not overwrite:
+            message += "\n{} images with existing label files were skipped.".format(len(existing))
+        mbFormat = QtWidgets.QMessageBox(QtWidgets.QMessageBox.Information, "Autosegmentation finished",
+                                         message,
+                                         QtWidgets.QMessageBox.Ok)
+        mbFormat.exec()
+        self.importDirImages(targetDirPath)
 
-                # Step 4: Modify `self.imagePath` to point to the new location
-                self.imagePath = new_image_path
+    def autosegmentation(self):
 
-                import stat
-                file_path = self.getJSONFile()
-                self.originalImageFile = self.filename
-                self.filename = file_path
-                self.labelFile = file_path
-                print(file_path)
-                dir_path = os.path.dirname(file_path)
+        if not self.mayContinue():
+            return
 
-                # Ensure directory exists with the right permissions
-                os.makedirs(dir_path, exist_ok=True)
-                os.chmod(dir_path, stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO)
+        if self.imagePath == None:
+            self.openFile()
+        if self.imagePath == None:
+            return
 
-                # If the file exists, set its permissions
-                if os.path.exists(file_path):
-                    os.chmod(file_path, stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO)
+        if not self.imagePath.lower().endswith((".png", ".tiff", ".tif")):
+            mbFormat = QtWidgets.QMessageBox(QtWidgets.QMessageBox.Warning, "Unsupported file format",
+                                             "Please choose PNG, TIF or TIFF image file.",
+                                             QtWidgets.QMessageBox.Ok)
+            mbFormat.exec()
+            return
 
-                import tempfile
+        self.traceProgress = QtWidgets.QProgressDialog("Autosegmentation...", "cancel", 0, 100,
+                                                       self)
+        self.traceProgress.setWindowModality(Qt.WindowModal)
+        self.traceProgress.forceShow()
+        self.traceProgress.setValue(1)
 
-                with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix=".json", encoding='utf-8') as tmpfile:
-                    json.dump(json_out, tmpfile)
-                    temp_name = tmpfile.name
+        # brightness and contrast set on the canvas are applied in memory and the
+        # adjusted image is handed to the model directly; otherwise the model reads the file
+        brightness, contrast = self.brightnessContrast_values.get(self.filename, (None, None))
+        adjusted = (brightness, contrast) != (None, None)
+        if adjusted:
+            image = load_image(self.imagePath)
+            image = ImageEnhance.Brightness(image).enhance(brightness / 50)
+            image = ImageEnhance.Contrast(image).enhance(contrast / 50)
+            source = image
+            imageSize = image.size
+        else:
+            source = self.imagePath
+            with Image.open(self.imagePath) as image:
+                imageSize = image.size
+        self.traceProgress.setValue(15)
+
+        model_path = os.path.dirname(__file__).replace("\\", "/") + "/experiments/" + self.currentModel
+
+        if self._config["autoseg_tile_size"]:
+            vineseg_list = predict_tiled(source, model_path,
+                                         tile_size=self._config["autoseg_tile_size"],
+                                         overlap=self._config["autoseg_tile_overlap"],
+                                         min_size=int(self.minMaxNeuronValues[0] // 2),
+                                         max_size=int(self.minMaxNeuronValues[1] * 2),
+                                         tolerance=self._config["autoseg_simplify_tolerance"])
+        else:
+            prediction_result = predict(source, model_path)
+            vineseg_list = None
+            if prediction_result[0].masks != None:
+                vineseg_list = get_vineseg_list(prediction_result, min_size=int(self.minMaxNeuronValues[0] // 2),
+                                                max_size=int(self.minMaxNeuronValues[1] * 2),
+                                                tolerance=self._config["autoseg_simplify_tolerance"])
+
+        if not vineseg_list:
+            vineseg_list = [{'shape_type': 'polygon', 'points': [], 'score': 0, 'label': 'Neuron'}]
+
+            mbFormat = QtWidgets.QMessageBox(QtWidgets.QMessageBox.Warning, "No shapes detected by this model.",
+                                             "Please try another model or adapt min/max size of neuronal bodies.",
+                                             QtWidgets.QMessageBox.Ok)
+            mbFormat.exec()
 
-                # If you want to move the temporary file to the desired location
-                shutil.move(temp_name, file_path)
+        self.traceProgress.setValue(90)
 
-                self.labelingMode = "Area"
-                self.traceProgress.setValue(self.traceProgress.maximum())
-                self.traceProgress.close()
+        # an adjusted image is saved once, to the annotation directory if one is set,
+        # otherwise next to the image; the label file goes where getJSONFile() looks for it
+        if adjusted:
+            image_dir = self.output_dir if self.output_dir else osp.dirname(self.imagePath)
+            self.imagePath = osp.join(image_dir, osp.splitext(osp.basename(self.imagePath))[0]
+                                      + "_b_{brightness}_c{contrast}.png".format(brightness=brightness,
+                                                                                 contrast=contrast))
+            image.save(self.imagePath)
 
-                # self.loadPolygons()
-                self.setClean()
+        file_path = self.getJSONFile()
+        if osp.normcase(osp.abspath(file_path)) == osp.normcase(osp.abspath(self.imagePath)):
+            self.traceProgress.close()
+            self.errorMessage("Autosegmentation failed",
+                              "The label file would replace the image {}.".format(self.imagePath))
+            return
+        os.makedirs(osp.dirname(file_path), exist_ok=True)
+        write_label_file(file_path, self.imagePath, vineseg_list, imageSize)
 
-                if self.filename:
-                    if self.filename.endswith(".json"):
-                        self.updateJSON()
-                        self.loadFile(self.filename, justJSON=True)
+        self.originalImageFile = self.filename
+        self.filename = file_path
+        self.labelFile = file_path
 
-            else:
-                self.traceProgress.close()
+        self.labelingMode = "Area"
+        self.traceProgress.setValue(self.traceProgress.maximum())
+        self.traceProgress.close()
 
-        else:
-            self.traceProgress.close()
+        self.setClean()
+        self.updateJSON()
+        self.loadFile(self.filename, justJSON=True)
         # load again here as it sometimes doesn't execute earlier (??)
         self.loadPolygons()
 
@@ -2603,14 +2597,14 @@ class MainWindow(QtWidgets.QMainWindow):
         if not self.mayContinue():
             return
         path = osp.dirname(str(self.filename)) if self.filename else "."
-        formats = ["*.tsv", ".txt"]
+        formats = ["*.tsv", "*.txt", "*.h5", "*.hdf5", "*.npy"]
         filters = self.tr("df/f files (%s)") % " ".join(
             formats)
         fileDialog = FileDialogPreview(self)
         fileDialog.setFileMode(FileDialogPreview.ExistingFile)
         fileDialog.setNameFilter(filters)
         fileDialog.setWindowTitle(
-            self.tr("%s - Choose df/f .tsv file") % __appname__,
+            self.tr("%s - Choose df/f file") % __appname__,
         )
         fileDialog.setWindowFilePath(path)
         fileDialog.setViewMode(FileDialogPreview.Detail)
@@ -2623,12 +2617,14 @@ class MainWindow(QtWidgets.QMainWindow):
         if not self.mayContinue():
             return
         if self.filename:
-            if os.path.exists(self.filename.replace(".json", "_traces_df_f.tsv")):
-                df_f_path = self.filename.replace(".json", "_traces_df_f.tsv")
+            df_f_paths = [self.filename.replace(".json", "_traces_df_f" + ext) for ext in (".tsv", ".h5", ".npy")]
+            df_f_paths = [path for path in df_f_paths if os.path.exists(path)]
+            if df_f_paths:
+                df_f_path = df_f_paths[0]
                 # ask if this path is correct
                 mb = QtWidgets.QMessageBox
                 msg = self.tr(
-                    "df/f values for this file found in " + self.filename.replace(".json", "_traces_df_f.tsv")
+                    "df/f values for this file found in " + df_f_path
                     + "\nUse this file as source for df/f values?")
                 c = mb.warning(self, self.tr("Confirm file"), msg, mb.Yes | mb.No)
                 if c == mb.Yes:
@@ -2646,13 +2642,24 @@ class MainWindow(QtWidgets.QMainWindow):
 
         # run cascade code
         if df_f_path:
+            model_path = os.path.join(os.path.sep, os.path.dirname(__file__), "CASCADE_models",
+                                      self.currentModelTraceX)
+            backend = self._config["cascade_backend"]
+            if select_backend(backend, model_path) is None:
+                self.errorMessage(
+                    self.tr("CASCADE not available"),
+                    self.tr("The model {} cannot be run: install TensorFlow or convert the model "
+                            "to ONNX.").format(self.currentModelTraceX))
+                return
+            budget = self._config["cascade_memory_budget"]
+            if budget is not None:
+                budget = int(budget * 2**20)
             self.traceProgress = QtWidgets.QProgressDialog("Running CASCADE Spike Inference...", "Cancel", 0, 10, self)
             self.traceProgress.setWindowModality(Qt.WindowModal)
             self.traceProgress.forceShow()
 
-            run_CASCADE(dff_path=df_f_path, model_name=os.path.join(os.path.sep, os.path.dirname(__file__),
-                                                                    "CASCADE_models", self.currentModelTraceX),
-                        pb=self.traceProgress)
+            run_CASCADE(dff_path=df_f_path, model_name=model_path, pb=self.traceProgress, budget=budget,
+                        backend=backend)
 
             mb = QtWidgets.QMessageBox
             msg = self.tr(
@@ -2668,7 +2675,7 @@ class MainWindow(QtWidgets.QMainWindow):
         else:
             defaultOpenDirPath = self.currentPath()
 
-        filters = self.tr("Trace files (*%s)") % "tsv"
+        filters = self.tr("Trace files (%s)") % TRACE_FILE_FORMATS
         dlg = QtWidgets.QFileDialog(
             self, "Choose where to store traces", defaultOpenDirPath, filters
         )
@@ -2684,7 +2691,7 @@ class MainWindow(QtWidgets.QMainWindow):
             self,
             self.tr("Choose where to store traces"),
             default_tracesfile_name,
-            self.tr("Traces files (*%s)") % "tsv",
+            self.tr("Traces files (%s)") % TRACE_FILE_FORMATS,
         )
         if isinstance(filename, tuple):
             filename, _ = filename
@@ -2809,38 +2816,47 @@ class MainWindow(QtWidgets.QMainWindow):
             print("No JSON file provided. abort")
             return
 
-        self.traceProgress = QtWidgets.QProgressDialog("Calculating Traces...", "cancel", 0, len(imagesArray), self)
+        traceFileName = self.saveTracesDialog()
+        if not traceFileName:
+            return
+
+        self.traceProgress = QtWidgets.QProgressDialog("Calculating Traces...", "cancel", 0, 100, self)
         self.traceProgress.setWindowModality(Qt.WindowModal)
         self.traceProgress.forceShow()
 
         self.traceProgress.setValue(1)
 
-        masks = []
-
-        for i in range(0, len(data['shapes'])):
-            # compute only for shapes with min confidence
-            if data['shapes'][i]['score'] * 100 >= self.getConfidence():
-                roimask = shape_to_mask((data['imageHeight'], data['imageWidth']), data['shapes'][i]['points'],
-                                        shape_type=None,
-                                        line_width=1, point_size=1)
-                masks.append(roimask)
+        # compute only for shapes with min confidence; the ROIs keep the index
+        # of their shape in the label file
+        indices = [i for i, shape in enumerate(data['shapes']) if shape['score'] * 100 >= self.getConfidence()]
+        shapes = [data['shapes'][i] for i in indices]
+        rois = tracemanager.compileRois((data['imageHeight'], data['imageWidth']), shapes,
+                                        engine=self._config["trace_engine"])
 
         self.traceProgress.setValue(10)
         
-        if isinstance(imagesArray, str):
-            tif = tfile.TiffFile(imagesArray)
-            tflen = len(tif.pages)
-            with Pool() as pool:
-                traces = pool.starmap(tracesForSlice, zip(repeat(imagesArray, tflen), list(range(0, tflen)), repeat(masks, tflen)))
+        def progress(done, total):
+            self.traceProgress.setValue(10 + int(done / total * (self.traceProgress.maximum() - 20)))
+
+        # traces are streamed to disk next to the trace file, into the trace file
+        # itself for .npy and into a scratch file otherwise; an interrupted
+        # extraction of the same recording resumes where it stopped
+        if osp.splitext(traceFileName)[1].lower() == ".npy":
+            streamPath = traceFileName
         else:
-            with Pool() as pool:
-                traces = pool.starmap(tracesForImage, zip(imagesArray, repeat(masks, len(imagesArray))))
-
-        self.traceProgress.setValue(self.traceProgress.maximum() - 10)
+            streamPath = traceFileName + ".extraction.npy"
+        traces = pipeline.extraction(imagesArray, rois, rois_from_shapes(shapes, indices=indices),
+                                     progress=progress, outPath=streamPath,
+                                     cancelled=self.traceProgress.wasCanceled)
+        if traces is None:
+            self.traceProgress.close()
+            mbFormat = QtWidgets.QMessageBox(QtWidgets.QMessageBox.Warning, "Trace extraction cancelled",
+                                             "Finished frames were kept. Extract the traces to the same file "
+                                             "again to resume.",
+                                             QtWidgets.QMessageBox.Ok)
+            mbFormat.exec()
+            return
 
-        traceFileName = self.saveTracesDialog()
-        # write traces to file
-        pd.DataFrame(data=np.array(traces)).to_csv(traceFileName, sep="\t", header=False, index=False)
         # copy json file to trace location
         # Step 1: Read the JSON file
         with open(self.getJSONFile(), 'r') as file:
@@ -2863,28 +2879,43 @@ class MainWindow(QtWidgets.QMainWindow):
                                                   "Please provide the wished long filter length [frames] for the dynamic baseline calculation (default: 5401 frames)",
                                                   5401, 0, 1000000)
 
+        # the raw traces are handed to the dF/F stage in memory, files are
+        # only written by the sinks; a .npy the traces were streamed to
+        # already is the raw trace store
+        if streamPath != traceFileName:
+            stages = [pipeline.sink(traceFileName)]
+        else:
+            write_rois(traceFileName, traces[1])
+            stages = []
+
         if ok and lfl:
-            self.traceProgress = QtWidgets.QProgressDialog("Calculating dF/F...", "cancel", 0, len(imagesArray), self)
+            self.traceProgress = QtWidgets.QProgressDialog("Calculating dF/F...", "cancel", 0, 10, self)
             self.traceProgress.setWindowModality(Qt.WindowModal)
             self.traceProgress.forceShow()
             self.traceProgress.setValue(1)
 
-            dff_calc(traceFileName, lfl)
+            pipeline.run_pipeline(traces, *stages, pipeline.dff_stage(lfl, processes=None),
+                                  pipeline.sink(derived_path(traceFileName, "_df_f")))
 
             self.traceProgress.setValue(self.traceProgress.maximum())
             self.traceProgress.close()
-            mbFormat = QtWidgets.QMessageBox(QtWidgets.QMessageBox.Warning, "Files Written",
-                                             "Raw Traces and dF/F files written to {}.".format(
-                                                 os.path.dirname(traceFileName)),
-                                             QtWidgets.QMessageBox.Ok)
-            mbFormat.exec()
+            title = "Files Written"
+            message = "Raw Traces and dF/F files written to {}.".format(os.path.dirname(traceFileName))
 
         else:
-            mbFormat = QtWidgets.QMessageBox(QtWidgets.QMessageBox.Warning, "No RWS was given",
-                                             "No rolling window size was given. Only raw traces were written to {}.".format(
-                                                 os.path.dirname(traceFileName)),
-                                             QtWidgets.QMessageBox.Ok)
-            mbFormat.exec()
+            pipeline.run_pipeline(traces, *stages)
+            title = "No RWS was given"
+            message = "No rolling window size was given. Only raw traces were written to {}.".format(
+                os.path.dirname(traceFileName))
+
+        # the scratch file is not needed once the sink wrote the raw traces;
+        # the memory map has to be released before it can be removed
+        if streamPath != traceFileName:
+            traces = None
+            os.remove(streamPath)
+
+        mbFormat = QtWidgets.QMessageBox(QtWidgets.QMessageBox.Warning, title, message, QtWidgets.QMessageBox.Ok)
+        mbFormat.exec()
 
         return
 
@@ -3095,12 +3126,12 @@ class MainWindow(QtWidgets.QMainWindow):
         label_file = self.imagePath.replace("\\", "/")
         dir_name = os.path.dirname(label_file)
         filename = os.path.basename(label_file)
-        if filename.endswith(".png"):
-            label_file = dir_name + "/predictions/" + filename.replace(".png", ".json")
-        elif filename.endswith(".tiff"):
-            label_file = dir_name + "/predictions/" + filename.replace(".tiff", ".json")
-        elif filename.endswith(".tif"):
-            label_file = dir_name + "/predictions/" + filename.replace(".tif", ".json")
+        if filename.lower().endswith((".png", ".tiff", ".tif")):
+            label_file = dir_name + "/predictions/" + osp.splitext(filename)[0] + ".json"
+
+        # autosegmentation writes to the annotation directory if one is set
+        if self.output_dir:
+            label_file = osp.join(self.output_dir, osp.basename(label_file))
 
         return label_file
 
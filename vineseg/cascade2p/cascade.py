@@ -36,6 +36,7 @@ import time
 import numpy as np
 import warnings
 from . import config, utils
+from .model_cache import model_cache
 
 
 
@@ -186,7 +187,9 @@ def train_model( model_name, model_folder='Pretrained_models', ground_truth_fold
     print('Runtime: {:.0f} min'.format((time.time() - start)/60))
 
 
-def predict( model_name, traces, model_folder='Pretrained_models', threshold=0, padding=np.nan ):
+def predict( model_name, traces, model_folder='Pretrained_models', threshold=0, padding=np.nan, use_cache=True,
+             trace_noise_levels=None, fuse_ensemble=False,
+             backend='keras' ):
 
     """ Use a specific trained neural network ('model_name') to predict spiking activity for calcium traces ('traces')
 
@@ -225,6 +228,26 @@ def predict( model_name, traces, model_folder='Pretrained_models', threshold=0,
         Value which is inserted for datapoints, where no prediction can be made (because of window around timepoint of prediction)
         Default value: np.nan, another recommended value would be 0 which circumvents some problems with following analysis.
 
+    use_cache : bool
+        If True (default), loaded models, the config and the model paths are kept in 'model_cache.model_cache'
+        and reused by later calls with the same model (e.g. for chunked predictions). If False, the models are
+        loaded for this call only and removed from memory afterwards.
+
+    trace_noise_levels : 1d numpy array (neurons), optional
+        Noise levels of the traces as computed by 'utils.calculate_noise_levels'. Pass the values of the complete
+        recording when 'traces' is only a time chunk of it, so that the same model is selected for every chunk.
+        Default: computed from 'traces'.
+
+    fuse_ensemble : bool
+        If True, the ensemble models of a noise level are combined into one model that averages their outputs
+        in-graph ('fuse_models'), so that the input windows are read once instead of once per ensemble member.
+        Only used with backend='keras'.
+
+    backend : str
+        'keras': predict with the Keras models (.h5 files), requires TensorFlow
+        'onnx': predict with the ONNX conversions of the models, requires onnxruntime but no TensorFlow.
+                Missing conversions are created next to the .h5 files ('onnx_models.convert_model_folder').
+
     Returns
     --------
     predicted_activity: 2d numpy array (neurons x nr_timepoints)
@@ -232,8 +255,14 @@ def predict( model_name, traces, model_folder='Pretrained_models', threshold=0,
         This array can contain NaNs if the value 'padding' was np.nan as input argument
 
     """
-    import tensorflow.keras
-    from tensorflow.keras.models import load_model
+    if backend == 'keras':
+        import tensorflow.keras
+        from tensorflow.keras.models import load_model
+    elif backend == 'onnx':
+        from .onnx_models import load_model
+        fuse_ensemble = False
+    else:
+        raise Exception('Invalid value of backend "{}". Only "keras" or "onnx" allowed'.format(backend))
 
     model_path = os.path.join(model_folder, model_name)
     cfg_file = os.path.join( model_path, 'config.yaml')
@@ -247,7 +276,10 @@ def predict( model_name, traces, model_folder='Pretrained_models', threshold=0,
         raise Exception(m)
 
     # Load config file
-    cfg = config.read_config( cfg_file )
+    if use_cache:
+        cfg = model_cache.config( cfg_file )
+    else:
+        cfg = config.read_config( cfg_file )
 
     # extract values from config file into variables
     verbose = cfg['verbose']
@@ -273,20 +305,27 @@ def predict( model_name, traces, model_folder='Pretrained_models', threshold=0,
     if verbose: print('Given argument traces contains {} neurons and {} frames.'.format( traces.shape[0], traces.shape[1]))
 
     # calculate noise levels for each trace
-    trace_noise_levels = utils.calculate_noise_levels(traces, sampling_rate)
+    if trace_noise_levels is None:
+        trace_noise_levels = utils.calculate_noise_levels(traces, sampling_rate)
 
     print('Noise levels (mean, std; in standard units): '+str(int(np.nanmean(trace_noise_levels*100))/100)+', '+str(int(np.nanstd(trace_noise_levels*100))/100))
 
     # Get model paths as dictionary (key: noise_level) with lists of model
     # paths for the different ensembles
-    model_dict = get_model_paths( model_path )  # function defined below
+    if use_cache:
+        model_dict = model_cache.model_paths( model_path )
+    else:
+        model_dict = get_model_paths( model_path )  # function defined below
     if verbose > 2: print('Loaded models:', str(model_dict))
 
-    # XX has shape: (neurons, timepoints, windowsize)
-    XX = utils.preprocess_traces(traces,
-                            before_frac = before_frac,
-                            window_size = window_size)
-    Y_predict = np.zeros( (XX.shape[0], XX.shape[1]) )
+    # network inputs (windows of shape (windowsize, 1)) are gathered in bounded float32
+    # batches from a strided view instead of a (neurons, timepoints, windowsize) array
+    start = int(before_frac * window_size - 1)
+    end = traces.shape[1] - window_size + start + 1
+    Y_predict = np.zeros( (traces.shape[0], traces.shape[1]), dtype=np.float32 )
+
+    # converted once here, so that the batches of every model and noise level are views of the same array
+    traces_float32 = np.ascontiguousarray( traces, dtype=np.float32 )
 
 
     # Use for each noise level the matching model
@@ -307,26 +346,31 @@ def predict( model_name, traces, model_folder='Pretrained_models', threshold=0,
             continue   # jump to next noise level
 
         # load keras models for the given noise level
-        models = list()
-        for model_path in model_dict[model_noise]:
-            models.append( load_model( model_path ) )
-
-        # select neurons and merge neurons and timepoints into one dimension
-        XX_sel = XX[neuron_idx, :, :]
-
-        XX_sel = np.reshape( XX_sel, (XX_sel.shape[0]*XX_sel.shape[1], XX_sel.shape[2]) )
-        XX_sel = np.expand_dims(XX_sel,axis=2)   # add empty third dimension to match training shape
+        # (models of noise levels without neurons are never loaded)
+        def load( files ):
+            models = [load_model( file ) for file in files]
+            return [fuse_models( models )] if fuse_ensemble else models
+
+        if use_cache:
+            models = model_cache.ensemble( model_path, model_noise, load,
+                                           variant=(backend, fuse_ensemble) )
+        else:
+            models = load( model_dict[model_noise] )
 
         for j, model in enumerate(models):
             if verbose: print('\t... ensemble', j)
 
-            prediction_flat = model.predict(XX_sel, batch_size, verbose=verbose )
-            prediction = np.reshape(prediction_flat, (len(neuron_idx),XX.shape[1]))
+            for XX_sel, neurons, timepoints in utils.window_batches(traces_float32, before_frac, window_size,
+                                                                    neuron_idx=neuron_idx):
+                prediction = model.predict(XX_sel, batch_size, verbose=0 )
+                Y_predict[neurons, timepoints] += prediction[:, 0] / len(models)  # average predictions
 
-            Y_predict[neuron_idx,:] += prediction / len(models)  # average predictions
+        # no complete window for the first and last timepoints
+        Y_predict[np.ix_(neuron_idx, np.r_[0:start, end:traces.shape[1]])] = np.nan
 
-        # remove models from memory
-        tensorflow.keras.backend.clear_session()
+        # remove models from memory (cached models are kept for the next call)
+        if not use_cache and backend == 'keras':
+            tensorflow.keras.backend.clear_session()
 
 
     if threshold is False:  # only if 'False' is passed as argument
@@ -334,27 +378,7 @@ def predict( model_name, traces, model_folder='Pretrained_models', threshold=0,
 
     elif threshold == 1:     # (1 or True)
       # Cut off noise floor (lower than 1/e of a single action potential)
-
-      from scipy.ndimage.filters import gaussian_filter
-      from scipy.ndimage.morphology import binary_dilation
-
-      # find out empirically  how large a single AP is (depends on frame rate and smoothing)
-      single_spike = np.zeros(1001,)
-      single_spike[501] = 1
-      single_spike_smoothed = gaussian_filter(single_spike.astype(float), sigma=smoothing*sampling_rate)
-      threshold_value = np.max(single_spike_smoothed)/np.exp(1)
-
-      # Set everything below threshold to zero.
-      # Use binary dilation to avoid clipping of true events.
-      for neuron in range(Y_predict.shape[0]):
-        # ignore warning because of nan's in Y_predict in comparison with value
-        with np.errstate(invalid='ignore'):
-            activity_mask = Y_predict[neuron,:] > threshold_value
-        activity_mask = binary_dilation(activity_mask,iterations = int(smoothing*sampling_rate))
-
-        Y_predict[neuron,~activity_mask] = 0
-
-        Y_predict[Y_predict<0] = 0  # set possible negative values in dilated mask to 0
+      threshold_activity( Y_predict, smoothing, sampling_rate )
 
     elif threshold == 0:
       # ignore warning because of nan's in Y_predict in comparison with value
@@ -430,6 +454,131 @@ def create_model_folder( config_dictionary, model_folder='Pretrained_models' ):
 
 
 
+def threshold_activity( Y_predict, smoothing, sampling_rate ):
+
+    """ Cut off the noise floor of predictions (threshold=1 in 'predict'), in place
+
+    Values below 1/e of the prediction for a single action potential are set to zero,
+    except within int(smoothing*sampling_rate) time points of a value above it (binary
+    dilation of the activity mask along time, to avoid clipping of true events). Negative
+    values are set to zero. All neurons are processed at once;
+    'checks.check_threshold_activity' compares this with the per-neuron loop it replaced.
+
+    Parameters
+    ------------
+    Y_predict : 2d numpy array (neurons x nr_timepoints)
+        Predicted spiking activity, can contain NaNs
+
+    smoothing, sampling_rate : float
+        Values of the config of the model
+
+    """
+    from scipy.ndimage.filters import gaussian_filter, maximum_filter1d
+
+    # find out empirically  how large a single AP is (depends on frame rate and smoothing)
+    single_spike = np.zeros(1001,)
+    single_spike[501] = 1
+    single_spike_smoothed = gaussian_filter(single_spike.astype(float), sigma=smoothing*sampling_rate)
+    threshold_value = np.max(single_spike_smoothed)/np.exp(1)
+
+    # Set everything below threshold to zero.
+    # Use binary dilation to avoid clipping of true events.
+    # ignore warning because of nan's in Y_predict in comparison with value
+    with np.errstate(invalid='ignore'):
+        activity_mask = Y_predict > threshold_value
+
+    iterations = int(smoothing*sampling_rate)
+    if iterations > 0:
+      # dilation along time by 'iterations' points on each side, for all neurons at once
+      activity_mask = maximum_filter1d(activity_mask.view(np.uint8), size=2*iterations+1, axis=1, mode='constant').view(bool)
+    else:
+      # binary_dilation with iterations < 1 repeats until nothing changes anymore
+      activity_mask[:] = np.any(activity_mask, axis=1, keepdims=True)
+
+    Y_predict[~activity_mask] = 0
+
+    with np.errstate(invalid='ignore'):
+        Y_predict[Y_predict<0] = 0  # set possible negative values in dilated mask to 0
+
+    return Y_predict
+
+
+def fuse_models( models ):
+
+    """ Combine ensemble members into a single model that returns their average prediction
+    ( Helper function called by predict() )
+
+    Returns
+    -------
+    model : keras model
+        Model with the input shape of the ensemble members, computing all members and their mean in one graph
+
+    """
+    from tensorflow.keras.layers import Input, Average
+    from tensorflow.keras.models import Model
+
+    if len(models) == 1:
+        return models[0]
+
+    inputs = Input( shape=models[0].input_shape[1:] )
+    for j, model in enumerate(models):
+        model._name = 'ensemble_{}'.format(j)   # loaded members share the same name, which a model does not allow
+    outputs = Average()( [model(inputs) for model in models] )
+
+    return Model( inputs=inputs, outputs=outputs )
+
+
+
+
+def select_backend( backend='auto', model_path=None ):
+
+    """ Backend for 'predict' that can be used on this machine
+
+    'keras' and 'onnx' are returned as given. For 'auto', 'keras' is returned if TensorFlow
+    is installed, otherwise 'onnx' if onnxruntime is installed and the models in 'model_path'
+    (if given) are converted ('onnx_models.convert_model_folder'). Returns None if neither
+    is possible.
+
+    """
+    if backend != 'auto':
+        return backend
+
+    try:
+        import tensorflow
+        return 'keras'
+    except ImportError:
+        pass
+
+    from . import onnx_models
+    if onnx_models.onnx_available() and (model_path is None or onnx_models.is_folder_converted( model_path )):
+        return 'onnx'
+    return None
+
+
+
+def backend_available( backend='auto', models_folder=None ):
+
+    """ True if 'backend' ('keras', 'onnx' or 'auto') can be used on this machine
+
+    'keras' needs TensorFlow, 'onnx' needs onnxruntime and, with 'models_folder', a model
+    folder in it whose models are converted to ONNX.
+
+    """
+    if backend in ('keras', 'auto'):
+        try:
+            import tensorflow
+            return True
+        except ImportError:
+            pass
+
+    if backend in ('onnx', 'auto'):
+        from . import onnx_models
+        return onnx_models.onnx_available( models_folder )
+
+    return False
+
+
+
 def get_model_paths( model_path ):
 
     """ Find all models in the model folder and return as dictionary
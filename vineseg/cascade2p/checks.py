@@ -44,3 +44,88 @@ def check_keras_version():
     print('\tTensorflow installed (version {}).'.format(tensorflow.__version__) )
 
     ## TODO: perform check that versions are compatible, notify user
+
+
+def check_onnx_parity(model_path, nb_windows=2048, tolerance=1e-4):
+    """ Compare the predictions of the ONNX conversions with the Keras models of a model folder
+
+    Random windows are predicted with each Keras model and its .onnx file (converted if
+    necessary). Returns True if all maximal absolute differences are below 'tolerance'.
+    """
+    import os
+    import numpy as np
+    from tensorflow.keras.models import load_model
+    from .cascade import get_model_paths
+    from . import onnx_models
+
+    rng = np.random.RandomState(0)
+    all_close = True
+
+    for noise_level, model_files in sorted(get_model_paths(model_path).items()):
+        for model_file in model_files:
+            keras_model = load_model(model_file)
+            X = rng.normal(scale=noise_level/100, size=(nb_windows,) + tuple(keras_model.input_shape[1:]))
+            X = X.astype(np.float32)
+
+            difference = np.max(np.abs(keras_model.predict(X, 1024) - onnx_models.load_model(model_file).predict(X, 1024)))
+            all_close &= bool(difference < tolerance)
+            print('\t{}: maximal difference {:.2e}'.format(os.path.basename(model_file), difference))
+
+    if all_close:
+        print('\tONNX models match the Keras models.')
+    else:
+        print('\tONNX models differ from the Keras models by more than {}.'.format(tolerance))
+    return all_close
+
+
+def check_threshold_activity(nb_neurons=50, nb_timepoints=5000):
+    """ Compare the thresholding of 'cascade.predict' (threshold=1) with the per-neuron loop it replaced
+
+    'cascade.threshold_activity' masks all neurons at once. Random predictions (with NaN
+    padding, negative values and neurons without activity) are thresholded by it and by the
+    former loop over neurons with 'binary_dilation', for dilation lengths of 0 (dilation until
+    nothing changes), 1 and several time points. Returns True if all results are identical.
+    """
+    import numpy as np
+    from scipy.ndimage.filters import gaussian_filter
+    from scipy.ndimage.morphology import binary_dilation
+    from .cascade import threshold_activity
+
+    def threshold_loop(Y_predict, smoothing, sampling_rate):
+        # thresholding of 'predict' before it was vectorized
+        single_spike = np.zeros(1001,)
+        single_spike[501] = 1
+        single_spike_smoothed = gaussian_filter(single_spike.astype(float), sigma=smoothing*sampling_rate)
+        threshold_value = np.max(single_spike_smoothed)/np.exp(1)
+
+        for neuron in range(Y_predict.shape[0]):
+            with np.errstate(invalid='ignore'):
+                activity_mask = Y_predict[neuron,:] > threshold_value
+            activity_mask = binary_dilation(activity_mask,iterations = int(smoothing*sampling_rate))
+
+            Y_predict[neuron,~activity_mask] = 0
+
+            with np.errstate(invalid='ignore'):
+                Y_predict[Y_predict<0] = 0
+        return Y_predict
+
+    rng = np.random.RandomState(0)
+    all_equal = True
+
+    for smoothing, sampling_rate in [(0.01, 30), (0.05, 30), (0.2, 7.5), (0.05, 100)]:
+        Y_predict = rng.normal(scale=0.05, size=(nb_neurons, nb_timepoints))
+        Y_predict[rng.rand(nb_neurons, nb_timepoints) < 0.01] = 0.5   # sparse events
+        Y_predict[:nb_neurons//10] = rng.normal(scale=0.001, size=(nb_neurons//10, nb_timepoints))   # no activity
+        Y_predict[:, :32] = np.nan   # padding as in 'predict'
+        Y_predict[:, -32:] = np.nan
+
+        expected = threshold_loop(Y_predict.copy(), smoothing, sampling_rate)
+        result = threshold_activity(Y_predict.copy(), smoothing, sampling_rate)
+
+        equal = np.array_equal(np.isnan(expected), np.isnan(result)) and \
+                np.array_equal(np.nan_to_num(expected), np.nan_to_num(result))
+        all_equal &= equal
+        print('\tsmoothing {}, sampling rate {} Hz: {}'.format(smoothing, sampling_rate,
+                                                               'identical' if equal else 'different'))
+
+    return all_equal
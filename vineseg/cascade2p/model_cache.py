@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""  In-process cache of loaded CASCADE models
+
+Loading the ensemble of Keras models for a noise level is the slowest part of
+'predict()' for small and medium datasets. The 'ModelCache' keeps loaded
+ensembles between calls, keyed by model folder and noise level, so that
+repeated or chunked runs of the same model load each .h5 file only once.
+
+Entries are evicted in least-recently-used order once the summed size of the
+cached .h5 files exceeds 'memory_budget' (bytes). Entries are reloaded when a
+model file or config.yaml changes on disk (modification time).
+
+The module-level instance 'model_cache' is used by 'cascade.predict()':
+
+    from cascade2p.model_cache import model_cache
+    model_cache.memory_budget = 512 * 2**20   # keep at most ~512 MB of models
+    model_cache.clear()                       # drop all loaded models
+
+"""
+
+import os
+from collections import OrderedDict
+
+from . import config
+
+
+class ModelCache:
+
+    """ Least-recently-used cache of model ensembles, configs and model paths
+
+    Parameters
+    ------------
+    memory_budget : int
+        Upper bound (in bytes, measured as size of the .h5 files) for the loaded
+        ensembles that are kept. The most recently used ensemble is always kept,
+        even if it alone exceeds the budget.
+
+    """
+
+    def __init__( self, memory_budget=2**30 ):
+        self.memory_budget = memory_budget
+        self._ensembles = OrderedDict()   # key -> (signature, models, nbytes)
+        self._configs = dict()            # cfg_file -> (mtime, cfg)
+        self._model_paths = dict()        # model_path -> (mtime, model_dict)
+
+    def __len__( self ):
+        return len(self._ensembles)
+
+    @property
+    def nbytes( self ):
+        """ Summed size of the model files of all cached ensembles """
+        return sum( entry[2] for entry in self._ensembles.values() )
+
+    def config( self, cfg_file ):
+        """ Return the content of 'cfg_file', re-reading it only after it changed """
+        cfg_file = os.path.abspath( cfg_file )
+        mtime = os.path.getmtime( cfg_file )
+        cached = self._configs.get( cfg_file )
+        if cached is None or cached[0] != mtime:
+            cached = ( mtime, config.read_config( cfg_file ) )
+            self._configs[cfg_file] = cached
+        return cached[1]
+
+    def model_paths( self, model_path ):
+        """ Return 'get_model_paths(model_path)', globbing the folder again only after it changed """
+        from .cascade import get_model_paths
+
+        model_path = os.path.abspath( model_path )
+        mtime = os.path.getmtime( model_path )
+        cached = self._model_paths.get( model_path )
+        if cached is None or cached[0] != mtime:
+            cached = ( mtime, get_model_paths( model_path ) )
+            self._model_paths[model_path] = cached
+        return cached[1]
+
+    def ensemble( self, model_path, noise_level, load, variant=None ):
+        """ Return the list of loaded models for one noise level of a model folder
+
+        Parameters
+        ------------
+        model_path : str
+            Folder with the config.yaml and .h5 files of the model
+        noise_level : int
+            Noise level key as returned by 'get_model_paths'
+        load : callable
+            Function that is called with the list of .h5 paths and returns the
+            object to be cached (e.g. the list of loaded Keras models)
+        variant : hashable, optional
+            Additional key part for different representations of the same files
+
+        """
+        files = self.model_paths( model_path )[noise_level]
+        key = ( os.path.abspath( model_path ), noise_level, variant )
+        signature = tuple( (file, os.path.getmtime(file)) for file in files )
+
+        entry = self._ensembles.get( key )
+        if entry is not None and entry[0] == signature:
+            self._ensembles.move_to_end( key )
+            return entry[1]
+
+        models = load( files )
+        nbytes = sum( os.path.getsize(file) for file in files )
+        self._ensembles[key] = ( signature, models, nbytes )
+        self._ensembles.move_to_end( key )
+        self._evict()
+        return models
+
+    def _evict( self ):
+        """ Drop least recently used ensembles until the budget is met """
+        while len(self._ensembles) > 1 and self.nbytes > self.memory_budget:
+            self._ensembles.popitem( last=False )
+
+    def clear( self ):
+        """ Drop all cached models, configs and model paths """
+        self._ensembles.clear()
+        self._configs.clear()
+        self._model_paths.clear()
+
+
+model_cache = ModelCache()
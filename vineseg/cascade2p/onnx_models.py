@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""  ONNX export and TensorFlow-free inference for CASCADE models
+
+The Keras models (.h5 files) of a model folder are converted once to ONNX and
+stored next to the originals ('Model_NoiseLevel_2_Ensemble_0.h5' ->
+'Model_NoiseLevel_2_Ensemble_0.onnx'). The converted files are used by
+'cascade.predict( ..., backend="onnx" )', which then only needs the package
+"onnxruntime" and no TensorFlow installation:
+
+    from cascade2p import onnx_models
+    onnx_models.convert_model_folder( model_path )   # with TensorFlow and tf2onnx installed
+
+    from cascade2p import cascade
+    spike_prob = cascade.predict( model_name, traces, backend='onnx' )   # with onnxruntime installed
+
+'cascade.select_backend( "auto", model_path )' picks the Keras models if TensorFlow
+is installed and the converted models otherwise.
+
+'checks.check_onnx_parity( model_path )' compares the outputs of the converted
+models with the Keras models.
+
+"""
+
+import os
+import numpy as np
+
+
+def _onnxruntime():
+    try:
+        import onnxruntime
+    except ModuleNotFoundError:
+        raise ModuleNotFoundError('The package "onnxruntime" is needed to predict with the ONNX backend. '
+                                  'Please install it with "pip install onnxruntime" or use backend="keras".')
+    return onnxruntime
+
+
+def _tf2onnx():
+    try:
+        import tf2onnx
+    except ModuleNotFoundError:
+        raise ModuleNotFoundError('The package "tf2onnx" is needed to convert CASCADE models to ONNX. '
+                                  'Please install it with "pip install tf2onnx".')
+    return tf2onnx
+
+
+def onnx_path( model_file ):
+    """ Path of the converted model for a Keras model file """
+    return os.path.splitext( model_file )[0] + '.onnx'
+
+
+def is_converted( model_file ):
+    """ True if the converted model exists and is not older than the Keras model """
+    converted = onnx_path( model_file )
+    return os.path.isfile( converted ) and os.path.getmtime( converted ) >= os.path.getmtime( model_file )
+
+
+def is_folder_converted( model_path ):
+    """ True if all Keras models of a model folder have an up-to-date ONNX conversion """
+    from .cascade import get_model_paths
+
+    try:
+        model_files = [file for files in get_model_paths( model_path ).values() for file in files]
+    except Exception:   # no models in this folder
+        return False
+    return all( is_converted( model_file ) for model_file in model_files )
+
+
+def onnx_available( models_folder=None ):
+    """ True if onnxruntime is installed and, with 'models_folder', one of its model folders is converted """
+    try:
+        import onnxruntime
+    except ImportError:
+        return False
+    if models_folder is None:
+        return True
+    return os.path.isdir( models_folder ) and any( is_folder_converted( os.path.join( models_folder, name ) )
+                                                   for name in os.listdir( models_folder ) )
+
+
+def convert_model( model_file, overwrite=False ):
+    """ Convert one Keras model file to ONNX, unless an up-to-date conversion exists
+
+    Returns
+    -------
+    path : str
+        Path of the .onnx file
+
+    """
+    converted = onnx_path( model_file )
+    if not overwrite and is_converted( model_file ):
+        return converted
+
+    tf2onnx = _tf2onnx()
+    import tensorflow as tf
+    from tensorflow.keras.models import load_model
+
+    model = load_model( model_file )
+    signature = [tf.TensorSpec( (None,) + tuple(model.input_shape[1:]), tf.float32, name='input' )]
+
+    # write to a temporary file first, so that an interrupted conversion leaves no broken model behind
+    tf2onnx.convert.from_keras( model, input_signature=signature, output_path=converted + '.tmp' )
+    os.replace( converted + '.tmp', converted )
+    tf.keras.backend.clear_session()
+
+    return converted
+
+
+def convert_model_folder( model_path, overwrite=False ):
+    """ Convert all models of a model folder (as found by 'get_model_paths') to ONNX
+
+    Returns
+    -------
+    model_dict : dict
+        Dictionary with noise_level (int) as keys and entries are lists of .onnx paths
+
+    """
+    from .cascade import get_model_paths
+
+    model_dict = dict()
+    for noise_level, model_files in get_model_paths( model_path ).items():
+        model_dict[noise_level] = [convert_model( model_file, overwrite=overwrite ) for model_file in model_files]
+    return model_dict
+
+
+class OnnxModel:
+
+    """ Converted CASCADE model with the 'predict' interface of a Keras model """
+
+    def __init__( self, path ):
+        onnxruntime = _onnxruntime()
+        self.path = path
+        self.session = onnxruntime.InferenceSession( path, providers=['CPUExecutionProvider'] )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict( self, X, batch_size=None, verbose=0 ):
+        X = np.asarray( X, dtype=np.float32 )
+        if batch_size is None:
+            batch_size = len(X)
+        outputs = [self.session.run( None, {self.input_name: X[first:first+batch_size]} )[0]
+                   for first in range(0, len(X), max(batch_size, 1))]
+        if not outputs:
+            return np.zeros( (0, 1), dtype=np.float32 )
+        return np.concatenate( outputs )
+
+
+def load_model( model_file ):
+    """ Load the converted model of a Keras model file; converts it first if necessary (requires TensorFlow) """
+    if not is_converted( model_file ):
+        convert_model( model_file )
+    return OnnxModel( onnx_path( model_file ) )
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""  Content-addressed cache of CASCADE results on disk
+
+Spike inference of a recording (network predictions and discrete spikes) takes
+minutes to hours, but only depends on the dF/F traces, the model and the
+inference parameters. The 'ResultCache' stores the results in one .npz file per
+combination, named after a hash of
+
+  - the dF/F matrix (values, shape and dtype),
+  - the files of the model folder (config.yaml and .h5 files; not their ONNX conversions),
+  - the parameters that are passed to 'key()' (e.g. threshold and padding).
+
+Entries that were not used for 'max_age' seconds are removed, and the least
+recently used entries are removed while the cache is larger than 'max_bytes'.
+
+    cache = ResultCache()
+    key = cache.key( traces, model_path, threshold=0, padding=np.nan )
+    result = cache.get( key )   # None or (spike_prob, discrete_approximation, spike_times)
+    if result is None:
+        ...
+        cache.put( key, spike_prob, discrete_approximation, spike_times )
+
+"""
+
+import os
+import time
+import hashlib
+import numpy as np
+
+# stored with every key; increase when the results for the same inputs change
+CACHE_VERSION = 1
+
+
+class ResultCache:
+
+    """ Cache of spike probabilities, discrete approximations and spike times
+
+    Parameters
+    ------------
+    folder : str
+        Folder with the cached results, default: ~/.vineseg/cascade_cache
+    max_bytes : int
+        Maximal summed size of the cached files
+    max_age : float
+        Seconds after the last use after which an entry is removed
+
+    """
+
+    def __init__( self, folder=None, max_bytes=2*2**30, max_age=30*24*3600 ):
+        if folder is None:
+            folder = os.path.join( os.path.expanduser('~'), '.vineseg', 'cascade_cache' )
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def key( self, traces, model_path, **parameters ):
+        """ Hash of the traces, the content of the model folder and the parameters """
+        digest = hashlib.sha1()
+        digest.update( repr( (CACHE_VERSION, traces.shape, str(traces.dtype)) ).encode() )
+        digest.update( np.ascontiguousarray( traces ).data )
+
+        for name in sorted( os.listdir( model_path ) ):
+            path = os.path.join( model_path, name )
+            if not os.path.isfile( path ) or name.endswith( ('.onnx', '.tmp') ):
+                continue
+            digest.update( name.encode() )
+            with open( path, 'rb' ) as file:
+                for block in iter( lambda: file.read( 2**20 ), b'' ):
+                    digest.update( block )
+
+        # sorted, so that the order of the keyword arguments does not matter
+        digest.update( repr( sorted( parameters.items() ) ).encode() )
+        return digest.hexdigest()
+
+    def _path( self, key ):
+        return os.path.join( self.folder, key + '.npz' )
+
+    def get( self, key ):
+        """ Return (spike_prob, discrete_approximation, spike_times) or None if not cached """
+        path = self._path( key )
+        try:
+            with np.load( path ) as data:
+                spike_prob = data['spike_prob']
+                approximation = data['discrete_approximation']
+                counts = data['spike_counts']
+                spike_times = np.split( data['spike_times'], np.cumsum( counts )[:-1] ) if len(counts) else []
+        except (OSError, KeyError, ValueError):
+            return None
+
+        os.utime( path )   # mark as recently used
+        return spike_prob, approximation, spike_times
+
+    def put( self, key, spike_prob, discrete_approximation, spike_times ):
+        """ Store the results of one recording and evict old entries """
+        os.makedirs( self.folder, exist_ok=True )
+
+        spike_times = [np.asarray( times, dtype=float ) for times in spike_times]
+        counts = np.array( [len(times) for times in spike_times], dtype=np.int64 )
+        times = np.concatenate( spike_times ) if spike_times else np.zeros( 0 )
+
+        # write to a temporary file first, so that readers never see a partial entry
+        path = self._path( key )
+        with open( path + '.tmp', 'wb' ) as file:
+            np.savez( file, spike_prob=spike_prob, discrete_approximation=discrete_approximation,
+                      spike_times=times, spike_counts=counts )
+        os.replace( path + '.tmp', path )
+
+        self.evict()
+
+    def evict( self ):
+        """ Remove entries older than max_age, then the least recently used ones above max_bytes """
+        if not os.path.isdir( self.folder ):
+            return
+
+        entries = []
+        for name in os.listdir( self.folder ):
+            if name.endswith( '.npz' ):
+                path = os.path.join( self.folder, name )
+                stat = os.stat( path )
+                entries.append( (stat.st_mtime, stat.st_size, path) )
+        entries.sort( reverse=True )   # most recently used first
+
+        now = time.time()
+        total = 0
+        for i, (mtime, size, path) in enumerate( entries ):
+            total += size
+            # the most recent entry is kept even if it alone exceeds max_bytes
+            if now - mtime > self.max_age or (i > 0 and total > self.max_bytes):
+                os.remove( path )
+
+    def clear( self ):
+        """ Remove all cached results """
+        if os.path.isdir( self.folder ):
+            for name in os.listdir( self.folder ):
+                if name.endswith( ('.npz', '.tmp') ):
+                    os.remove( os.path.join( self.folder, name ) )
@@ -14,6 +14,9 @@ Helper functions for CASCADE:
   preprocess_traces():
     converts calcium data to a format that can be used by the deep network
 
+  sliding_windows(), window_batches():
+    strided (copy-free) version of preprocess_traces() that yields bounded batches
+
   calibrated_ground_truth_artificial_noise():
     resamples ground truth datasets at a given noise level and frame rate
 
@@ -143,6 +146,70 @@ def preprocess_traces(neurons_x_time, before_frac, window_size):
 
 
 
+def sliding_windows(neurons_x_time, window_size):
+
+    """
+    Strided view on all complete windows of the dF/F traces, without copying.
+
+    input:  dF/F traces (matrix with nb_neurons x time_points, float32, C-contiguous)
+            window_size (size of the receptive window of the deep network)
+    output: read-only view with nb_neurons x (time_points - window_size + 1) x window_size;
+            window i of a neuron covers the time points i ... i+window_size-1
+
+    The view corresponds to the valid part of preprocess_traces(), i.e. X[:, start:end, :].
+    as_strided is used instead of sliding_window_view to support numpy < 1.20.
+
+    """
+    from numpy.lib.stride_tricks import as_strided
+
+    nb_windows = max(neurons_x_time.shape[1] - window_size + 1, 0)
+    stride_neuron, stride_time = neurons_x_time.strides
+    return as_strided(neurons_x_time,
+                      shape=(neurons_x_time.shape[0], nb_windows, window_size),
+                      strides=(stride_neuron, stride_time, stride_time),
+                      writeable=False)
+
+
+
+def window_batches(neurons_x_time, before_frac, window_size, neuron_idx=None, max_windows=2**16):
+
+    """
+    Generator over the network inputs of preprocess_traces() in bounded float32 batches.
+
+    Instead of materializing nb_neurons x time_points x window_size values, the windows of the
+    selected neurons are gathered from a strided view, at most 'max_windows' at a time. Peak
+    memory is therefore independent of the recording length.
+
+    input:  dF/F traces (matrix with nb_neurons x time_points)
+            before_frac, window_size (as for preprocess_traces())
+            neuron_idx (indices of the neurons to use; default: all)
+            max_windows (number of windows per batch)
+    output: tuples (X, neurons, timepoints), with X of shape (n, window_size, 1) and the neuron
+            and time point indices that the n windows are predicting
+
+    Time points without a complete window (NaN in preprocess_traces()) are not yielded.
+    Traces that are not a C-contiguous float32 array are copied on every call; convert them
+    once when iterating several times (e.g. once per ensemble model).
+
+    """
+    traces = np.ascontiguousarray(neurons_x_time, dtype=np.float32)
+    if neuron_idx is None:
+        neuron_idx = np.arange(traces.shape[0])
+    neuron_idx = np.asarray(neuron_idx)
+
+    start = int(before_frac * window_size -1)
+    windows = sliding_windows(traces, window_size)
+    nb_windows = windows.shape[1]
+
+    for first in range(0, len(neuron_idx) * nb_windows, max_windows):
+        flat = np.arange(first, min(first + max_windows, len(neuron_idx) * nb_windows))
+        neurons = neuron_idx[flat // nb_windows]
+        windows_idx = flat % nb_windows
+        X = windows[neurons, windows_idx]
+        yield np.expand_dims(X, axis=2), neurons, windows_idx + start
+
+
+
 
 def calibrated_ground_truth_artificial_noise(ground_truth_folder,noise_level,sampling_rate,replicas,omission_list=[], verbose=3):
 
@@ -8,12 +8,13 @@ Infer discrete spikes from probabilities: define helper functions
 """
 
 
-from scipy.ndimage.filters import gaussian_filter
+from scipy.ndimage.filters import gaussian_filter, gaussian_filter1d
 import scipy.ndimage as ndim
-from copy import deepcopy
 import numpy as np
 import os
 import scipy.io as sio
+from multiprocessing import Pool, RawArray
+from functools import lru_cache
 
 from . import config
 
@@ -21,12 +22,18 @@ from . import config
 
 
 
-def infer_discrete_spikes(spike_rates,model_name,model_folder='Pretrained_models'):
+def infer_discrete_spikes(spike_rates,model_name,model_folder='Pretrained_models',processes=1,seed=None):
 
   """
 
   Main function. Detailed documentation: To be done.
 
+  Neurons are independent of each other; with processes != 1 they are distributed over a
+  process pool (processes=None: one process per CPU). The random numbers of each neuron are
+  then drawn from its own generator, seeded with (seed, neuron index), so that the result does
+  not depend on the number of processes. With processes=1 and seed=None, numpy's global
+  random state is used as before.
+
   """
 
   model_path = os.path.join(model_folder, model_name)
@@ -47,71 +54,132 @@ def infer_discrete_spikes(spike_rates,model_name,model_folder='Pretrained_models
   sampling_rate = cfg['sampling_rate']
   smoothing = cfg['smoothing']
 
-  spikes_all = []
-  approximations_all = np.nan*np.ones(spike_rates.shape)
+  nb_neurons = spike_rates.shape[0]
 
-  for neuron in range(spike_rates.shape[0]):
+  if processes == 1:
 
-    print('Infer spikes for neuron '+str(neuron+1)+' out of '+str(spike_rates.shape[0]))
+    spikes_all = []
+    approximations_all = np.nan*np.ones(spike_rates.shape)
 
-    prob_density = spike_rates[neuron,:]
+    for neuron in range(nb_neurons):
 
-    spike_locs_all = []
+      print('Infer spikes for neuron '+str(neuron+1)+' out of '+str(nb_neurons))
 
-    # find non-nan indices (first and last frames of predictions are NaNs)
-    nnan_indices = ~np.isnan(prob_density)
-    # offset in time to assign inferred spikes to correct positions in the end
-    offset = np.argmax(nnan_indices==True) - 1
+      rng = None if seed is None else neuron_rng(seed, neuron)
+      approximations_all[neuron,:], spike_locs = infer_neuron(spike_rates[neuron,:],smoothing*sampling_rate,rng)
+      spikes_all.append(spike_locs)
 
-    if np.sum(nnan_indices) > 0:
+    return approximations_all, spikes_all
 
-      prob_density = prob_density[nnan_indices]
+  # approximations are written by the workers into shared memory, spike locations are returned
+  shape = spike_rates.shape
+  rates = RawArray('d', int(np.prod(shape)))
+  np.frombuffer(rates).reshape(shape)[:] = spike_rates
+  approximations = RawArray('d', int(np.prod(shape)))
 
-      vector_of_indices = np.arange(0,len(prob_density))
-      # "support_slices", indices of continuous chunks of the array which are non-zero and which might contain spikes
-      support_slices = divide_and_conquer(prob_density,smoothing*sampling_rate)
+  spikes_all = [None]*nb_neurons
+  with Pool(processes, initializer=_init_worker, initargs=(rates, approximations, shape, smoothing*sampling_rate, seed or 0)) as pool:
+    for nb_done, (neuron, spike_locs) in enumerate(pool.imap_unordered(_infer_worker, range(nb_neurons))):
+      print('Inferred spikes for '+str(nb_done+1)+' out of '+str(nb_neurons)+' neurons')
+      spikes_all[neuron] = spike_locs
 
-      approximation = np.zeros(prob_density.shape)
-      # go through each slice separately
-      for k in range(len(support_slices)):
+  approximations_all = np.frombuffer(approximations).reshape(shape).copy()
 
-        spike_locs = []
+  return approximations_all, spikes_all
 
-        nb_spikes = np.sum(prob_density[support_slices[k]])
 
-        # Monte Carlo/Metropolis-based sampling, initial guess of spikes
-        spike_locs,approximation[support_slices[k]],counter = fill_up_APs(prob_density[support_slices[k]],smoothing*sampling_rate,nb_spikes,spike_locs)
 
-        # every spike is shifted to any other position (no sub-pixel resolution) and the best position is used
-        spike_locs,approximation[support_slices[k]] = systematic_exploration(prob_density[support_slices[k]],smoothing*sampling_rate,nb_spikes,spike_locs,approximation[support_slices[k]])
+def neuron_rng(seed,neuron):
 
-        # refine initial guess using random shifts or removal of spikes
-        for jj in range(5):
-          # remove the worst spikes
-          spike_locs,approximation[support_slices[k]] = prune_APs(prob_density[support_slices[k]],smoothing*sampling_rate,nb_spikes,spike_locs,approximation[support_slices[k]])
-          # fill up spikes again
-          nb_spikes = np.sum(prob_density[support_slices[k]]) - np.sum(approximation[support_slices[k]])
-          spike_locs,approximation[support_slices[k]],counter = fill_up_APs(prob_density[support_slices[k]],smoothing*sampling_rate,nb_spikes,spike_locs)
+  """
 
-        # every spike is shifted to any other position (no sub-pixel resolution) and the best position is used
-        spike_locs,approximation[support_slices[k]] = systematic_exploration(prob_density[support_slices[k]],smoothing*sampling_rate,nb_spikes,spike_locs,approximation[support_slices[k]])
+  neuron_rng(): random generator of a single neuron, independent of the order in which neurons are processed
 
-        temporal_offset = vector_of_indices[support_slices[k]][0]
-        new_spikes = spike_locs+temporal_offset
-        spike_locs_all.extend(new_spikes)
+  """
+  return np.random.RandomState([seed, neuron])
 
-      approximations_all[neuron,nnan_indices] = approximation
 
-    spikes_all.append(spike_locs_all+offset)
 
-  return approximations_all, spikes_all
+# state of a spike inference worker, set once per process by _init_worker
+_worker = {}
+
+def _init_worker(rates,approximations,shape,smoothingX,seed):
+  _worker['spike_rates'] = np.frombuffer(rates).reshape(shape)
+  _worker['approximations'] = np.frombuffer(approximations).reshape(shape)
+  _worker['smoothingX'] = smoothingX
+  _worker['seed'] = seed
+
+def _infer_worker(neuron):
+  rng = neuron_rng(_worker['seed'], neuron)
+  _worker['approximations'][neuron,:], spike_locs = infer_neuron(_worker['spike_rates'][neuron,:],_worker['smoothingX'],rng)
+  return neuron, spike_locs
+
+
+
+def infer_neuron(prob_density,smoothingX,rng=None):
+
+  """
+
+  infer_neuron(): infers the discrete spikes of a single neuron from its spike probabilities (prob_density).
+  Returns the approximation (NaN where prob_density is NaN) and the spike locations.
+
+  """
+  approximation_all = np.nan*np.ones(prob_density.shape)
+
+  spike_locs_all = []
+
+  # find non-nan indices (first and last frames of predictions are NaNs)
+  nnan_indices = ~np.isnan(prob_density)
+  # offset in time to assign inferred spikes to correct positions in the end
+  offset = np.argmax(nnan_indices==True) - 1
 
+  if np.sum(nnan_indices) > 0:
 
+    prob_density = prob_density[nnan_indices]
 
+    vector_of_indices = np.arange(0,len(prob_density))
+    # "support_slices", indices of continuous chunks of the array which are non-zero and which might contain spikes
+    support_slices = divide_and_conquer(prob_density,smoothingX)
 
+    approximation = np.zeros(prob_density.shape)
+    # go through each slice separately
+    for k in range(len(support_slices)):
+
+      spike_locs = []
+
+      nb_spikes = np.sum(prob_density[support_slices[k]])
+
+      # Monte Carlo/Metropolis-based sampling, initial guess of spikes
+      spike_locs,approximation[support_slices[k]],counter = fill_up_APs(prob_density[support_slices[k]],smoothingX,nb_spikes,spike_locs,rng)
+
+      # every spike is shifted to any other position (no sub-pixel resolution) and the best position is used
+      spike_locs,approximation[support_slices[k]] = systematic_exploration(prob_density[support_slices[k]],smoothingX,nb_spikes,spike_locs,approximation[support_slices[k]])
+
+      # refine initial guess using random shifts or removal of spikes
+      for jj in range(5):
+        # remove the worst spikes
+        spike_locs,approximation[support_slices[k]] = prune_APs(prob_density[support_slices[k]],smoothingX,nb_spikes,spike_locs,approximation[support_slices[k]])
+        # fill up spikes again
+        nb_spikes = np.sum(prob_density[support_slices[k]]) - np.sum(approximation[support_slices[k]])
+        spike_locs,approximation[support_slices[k]],counter = fill_up_APs(prob_density[support_slices[k]],smoothingX,nb_spikes,spike_locs,rng)
+
+      # every spike is shifted to any other position (no sub-pixel resolution) and the best position is used
+      spike_locs,approximation[support_slices[k]] = systematic_exploration(prob_density[support_slices[k]],smoothingX,nb_spikes,spike_locs,approximation[support_slices[k]])
+
+      temporal_offset = vector_of_indices[support_slices[k]][0]
+      new_spikes = spike_locs+temporal_offset
+      spike_locs_all.extend(new_spikes)
+
+    approximation_all[nnan_indices] = approximation
 
+  return approximation_all, spike_locs_all+offset
 
-def fill_up_APs(prob_density,smoothingX,nb_spikes,spike_locs):
+
+
+
+
+
+def fill_up_APs(prob_density,smoothingX,nb_spikes,spike_locs,rng=None):
 
   """
 
@@ -122,13 +190,21 @@ def fill_up_APs(prob_density,smoothingX,nb_spikes,spike_locs):
   the difference over time. This is a variation of a Monte Carlo / Metropolis algorithm.
   Technically, it generates a cumulative distribution and samples randomly along the y-axis of the
   cumulative distribution.
+  Random numbers are drawn from rng (np.random.RandomState), or from numpy's global state if rng is None.
+
+  A proposed spike only changes the approximation within its support (see spike_kernels()), so the
+  approximation, its sum and the error change are updated within this window only.
 
   """
+  lo, weights = spike_kernels(len(prob_density), smoothingX)
+  width = weights.shape[1]
+
   # produce approximation based on previously inferred spikes (spike_locs)
   approximation = np.zeros(prob_density.shape)
   for spike in spike_locs:
     approximation[spike] += 1
   approximation =  gaussian_filter(approximation.astype(float), sigma=smoothingX)
+  approximation_sum = np.sum(approximation)
 
   # sample additional spike guesses using a Monte Carlo/Metropolis sampling scheme
   #
@@ -136,28 +212,28 @@ def fill_up_APs(prob_density,smoothingX,nb_spikes,spike_locs):
   # the added spike is accepted or rejected based on whether the
   # error of the approximation decreases or not
   counter = 0
-  while np.sum(approximation) < nb_spikes and counter < nb_spikes*20:
+  while approximation_sum < nb_spikes and counter < nb_spikes*20:
 
     if np.mod(counter,np.ceil(nb_spikes/10)) == 0:
       # a weighted cumulative probability distribution is computed; it is
-      # recomputed every each time 10% of the spikes have been assigned
-      norm_cum_distribution = np.cumsum(np.exp(prob_density - approximation) - 1)
-      norm_cum_distribution /= np.max(norm_cum_distribution)
-
-    spike_location = np.argmin(np.abs(norm_cum_distribution - np.random.uniform()))
+      # recomputed every each time 10% of the spikes have been assigned.
+      # Only timepoints where the probability exceeds the approximation contribute,
+      # so that the distribution is non-decreasing and can be searched by bisection
+      norm_cum_distribution = np.cumsum(np.maximum(np.exp(prob_density - approximation) - 1, 0))
+      if norm_cum_distribution[-1] <= 0:
+        break   # the approximation reaches the probability everywhere, no added spike can reduce the error
+      norm_cum_distribution /= norm_cum_distribution[-1]
 
-    approximation_temp = deepcopy(approximation)
-    this_spike =  np.zeros(prob_density.shape)
-    this_spike[spike_location] = 1
-    this_spike =  gaussian_filter(this_spike.astype(float), sigma=smoothingX)
-    approximation += this_spike
+    spike_location = sample_location(norm_cum_distribution, np.random.uniform() if rng is None else rng.uniform())
 
-    error_change = np.sum(np.abs(prob_density - approximation))  -  np.sum(np.abs(prob_density - approximation_temp))
+    window = slice(lo[spike_location], lo[spike_location] + width)
+    residual = prob_density[window] - approximation[window]
+    error_change = np.sum(np.abs(residual - weights[spike_location]) - np.abs(residual))
 
     if error_change <= 0:
       spike_locs.append(spike_location)
-    else:
-      approximation = deepcopy(approximation_temp)
+      approximation[window] += weights[spike_location]
+      approximation_sum += np.sum(weights[spike_location])
 
     counter += 1
 
@@ -165,6 +241,19 @@ def fill_up_APs(prob_density,smoothingX,nb_spikes,spike_locs):
 
 
 
+def sample_location(cum_distribution,value):
+
+  """
+
+  sample_location(): first timepoint at which the non-decreasing cumulative distribution (normalized to 1)
+  exceeds value, found by bisection; with a uniformly drawn value, timepoints are sampled in proportion
+  to the increments of the distribution
+
+  """
+  return min(np.searchsorted(cum_distribution, value, side='right'), len(cum_distribution)-1)
+
+
+
 def divide_and_conquer(prob_density,smoothingX):
 
   """
@@ -183,6 +272,40 @@ def divide_and_conquer(prob_density,smoothingX):
 
 
 
+@lru_cache(maxsize=32)
+def spike_kernels(length,smoothingX):
+
+  """
+
+  spike_kernels(): smoothed single spikes for every timepoint of an array with the given length, as
+  gaussian_filter(impulse, sigma=smoothingX) would produce them, but stored only within their support.
+  The smoothed spike at timepoint t is weights[t] at the indices lo[t] ... lo[t]+width-1.
+  Spikes close to the borders contain the tails that the 'reflect' mode of gaussian_filter folds back.
+
+  """
+  radius = int(4.0*smoothingX + 0.5)   # truncation of gaussian_filter
+  width = min(2*radius + 1, length)
+
+  lo = np.clip(np.arange(length) - radius, 0, length - width)
+
+  impulse = np.zeros(2*radius + 1)
+  impulse[radius] = 1
+  kernel = gaussian_filter1d(impulse, sigma=smoothingX)
+
+  weights = np.empty((length, width))
+  weights[:] = kernel[:width]
+  # exact (folded) kernels where the support reaches the borders
+  for timepoint in list(range(min(radius, length))) + list(range(max(length - radius, radius), length)):
+    impulse = np.zeros(length)
+    impulse[timepoint] = 1
+    weights[timepoint] = gaussian_filter1d(impulse, sigma=smoothingX)[lo[timepoint]:lo[timepoint] + width]
+
+  lo.setflags(write=False)
+  weights.setflags(write=False)
+  return lo, weights
+
+
+
 def systematic_exploration(prob_density,smoothingX,nb_spikes,spike_locs,approximation):
 
   """
@@ -190,28 +313,37 @@ def systematic_exploration(prob_density,smoothingX,nb_spikes,spike_locs,approxim
   systematic_exploration(): for each spike, all other possible locations in the probability density are tested.
   If any position is any better than the initial guess, it is accepted, otherwise rejected.
 
+  Moving a spike only changes the approximation within the support of the two smoothed spikes, so the error
+  of all positions is the error without the spike plus a change within the support of the new spike.
+
   """
-  # smoothed single spikes, initialized now beforehand because the creation takes time
-  spike_reservoir = np.zeros((len(approximation),len(approximation)))
-  for timepoint in range(len(approximation)):
-    spike_reservoir[timepoint,timepoint] = 1
-    spike_reservoir[timepoint,:] =  gaussian_filter( (spike_reservoir[timepoint,:]).astype(float), sigma=smoothingX)
+  if len(spike_locs) == 0:
+    return spike_locs,approximation
+
+  lo, weights = spike_kernels(len(approximation), smoothingX)
+  support = lo[:,None] + np.arange(weights.shape[1])
+
+  approximation = np.array(approximation, dtype=float)
 
-  # add a spike at "timepoint", subtract the existing spike at "spike"
-  error = np.zeros(approximation.shape)
   for spike_index,spike in enumerate(spike_locs):
-    for timepoint in range(len(approximation)):
-      approximation_suggestion = approximation + spike_reservoir[timepoint] - spike_reservoir[spike]
-      error[timepoint] = np.sum(np.abs(prob_density - approximation_suggestion))
+    # remove the existing spike at "spike" ...
+    approximation[lo[spike]:lo[spike]+weights.shape[1]] -= weights[spike]
+
+    # ... and add a spike at any "timepoint"
+    residual = prob_density - approximation
+    residual_support = residual[support]
+    error = np.sum(np.abs(residual)) + np.sum(np.abs(residual_support - weights) - np.abs(residual_support), axis=1)
 
     ix = np.argmin(error)
 
     spike_locs[spike_index] = ix
+    approximation[lo[ix]:lo[ix]+weights.shape[1]] += weights[ix]
 
-    approximation = np.zeros(prob_density.shape)
-    for spike in spike_locs:
-      approximation[spike] += 1
-    approximation =  gaussian_filter(approximation.astype(float), sigma=smoothingX)
+  # recompute once to avoid accumulation of rounding errors
+  approximation = np.zeros(prob_density.shape)
+  for spike in spike_locs:
+    approximation[spike] += 1
+  approximation =  gaussian_filter(approximation.astype(float), sigma=smoothingX)
 
   return spike_locs,approximation
 
@@ -223,22 +355,24 @@ def prune_APs(prob_density,smoothing,nb_spikes,spike_locs,approximation):
 
   prune_APs(): chooses a random pair of two spikes and moves them randomly in small steps.
   If the result improves the fit, it is accepted, otherwise rejected.
+  The error change of removing a spike is computed within the support of the spike only (see spike_kernels()).
 
   """
-  # produce approximation based on previously inferred spikes (spike_locs)
-  for spike_ix,spike1 in enumerate(spike_locs):
+  lo, weights = spike_kernels(len(prob_density), smoothing)
+  width = weights.shape[1]
 
-    spike_neg = np.zeros(prob_density.shape)
-    spike_neg[spike1] = 1
-    spike_neg =  gaussian_filter(spike_neg.astype(float), sigma=smoothing)
+  approximation = np.array(approximation, dtype=float)
 
-    approximation_temp = approximation - spike_neg
+  # produce approximation based on previously inferred spikes (spike_locs)
+  for spike_ix,spike1 in enumerate(spike_locs):
 
-    error_change = np.sum(np.abs(prob_density - approximation_temp))  -  np.sum(np.abs(prob_density - approximation))
+    window = slice(lo[spike1], lo[spike1] + width)
+    residual = prob_density[window] - approximation[window]
+    error_change = np.sum(np.abs(residual + weights[spike1]) - np.abs(residual))
 
     if error_change < 0:
       spike_locs[spike_ix] = -1
-      approximation -= spike_neg
+      approximation[window] -= weights[spike1]
 
   spike_locs = [x for x in spike_locs if x >= 0]
 
@@ -51,6 +51,10 @@ def validate_config_item(key, value):
         raise ValueError(
             "Unexpected value for config key 'shape_color': {}".format(value)
         )
+    if key == "trace_engine" and value not in ["sparse", "label"]:
+        raise ValueError(
+            "Unexpected value for config key 'trace_engine': {}".format(value)
+        )
     if key == "labels" and value is not None and len(value) != len(set(value)):
         raise ValueError(
             "Duplicates are detected for config key 'labels': {}".format(value)
@@ -8,8 +8,12 @@ import pandas as pd
 
 # cascade2p packages, imported from the downloaded Github repository
 from .cascade2p import cascade # local folder
+from .cascade2p.model_cache import model_cache
+from .cascade2p.result_cache import ResultCache
+from .cascade2p.utils import calculate_noise_levels
 from .cascade2p.utils import plot_dFF_traces, plot_noise_level_distribution, plot_noise_matched_ground_truth
 from .cascade2p.utils_discrete_spikes import infer_discrete_spikes
+from .traces.store import read_traces, read_rois, write_traces, is_binary
 
 import sys
 from PyQt5 import QtWidgets
@@ -44,12 +48,96 @@ def load_neurons_x_time(file_path):
     else:
         return traces
 
-def run_CASCADE(dff_path, model_name, pb):
-
+# peak memory per (neuron, time point) inside cascade.predict(): the float64 temporaries of
+# the noise levels (16 bytes); afterwards the float32 traces and predictions and the
+# threshold mask take ~10 bytes
+BYTES_PER_SAMPLE = 16
+# memory kept free for the loaded models and the window batches
+MEMORY_RESERVE = 256 * 2**20
+
+
+def available_memory():
+    """Return the available system memory in bytes, or None if it cannot be determined"""
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def memory_budget(budget=None):
+    """Return the number of bytes CASCADE may use: the user budget, at most half the available memory"""
+    available = available_memory()
+    if available is not None:
+        available = available // 2
+    budgets = [b for b in (budget, available) if b is not None]
+    if not budgets:
+        budgets = [2 * 2**30]
+    return max(min(budgets) - MEMORY_RESERVE, BYTES_PER_SAMPLE)
+
+
+def plan_chunks(shape, budget, halo):
+    """Split a (neurons, time points) array into chunks that fit into the memory budget
+
+    Whole traces are kept together as long as a single trace fits, otherwise each trace is split
+    in time into cores that are extended by 'halo' time points on both sides.
+
+    Returns a list of (neurons, (start, stop), (core_start, core_stop)) with a neuron slice, the
+    time range to predict on and the time range of the result that is taken from this chunk.
+    """
+    nb_neurons, nb_frames = shape
+    samples = max(budget // BYTES_PER_SAMPLE, 1)
+
+    if nb_frames <= samples:
+        per_chunk = max(samples // max(nb_frames, 1), 1)
+        return [(slice(first, min(first + per_chunk, nb_neurons)), (0, nb_frames), (0, nb_frames))
+                for first in range(0, nb_neurons, per_chunk)]
+
+    core = max(samples - 2 * halo, 2 * halo, 1)
+    chunks = []
+    for neuron in range(nb_neurons):
+        for core_start in range(0, nb_frames, core):
+            core_stop = min(core_start + core, nb_frames)
+            chunks.append((slice(neuron, neuron + 1),
+                           (max(core_start - halo, 0), min(core_stop + halo, nb_frames)),
+                           (core_start, core_stop)))
+    return chunks
+
+
+def run_CASCADE(dff_path, model_name, pb, budget=None, use_cache=True, backend='auto'):
+    """Predict spike probabilities and discrete spikes for a dF/F file
+
+    'budget' limits the memory (in bytes) used for the prediction; by default half of the available
+    memory is used. Larger inputs are processed in chunks of neurons, long recordings additionally
+    in time chunks with overlapping windows, so that the result does not depend on the chunking.
+
+    With 'use_cache', the results are stored in a ResultCache and reused when the same traces are
+    analysed again with the same model.
+
+    'backend' is passed to cascade.predict(): 'keras' (TensorFlow), 'onnx' (converted models,
+    onnxruntime only) or 'auto' (see cascade.select_backend()).
+    """
+    selected = cascade.select_backend(backend, model_name)
+    if selected is None:
+        raise Exception('CASCADE needs TensorFlow, or onnxruntime and models converted to ONNX '
+                        '(cascade2p.onnx_models.convert_model_folder) for "{}".'.format(model_name))
 
     pb.setValue(1)
 
-    traces = pd.read_csv(dff_path, sep="\t", header=None).T.to_numpy()
+    traces = np.asarray(read_traces(dff_path))
 
     if np.nanmedian(np.nanstd(traces, axis=1)) > 2:
         print('Fluctuations in dF/F are very large, probably dF/F is given in percent. Traces are divided by 100.')
@@ -57,33 +145,69 @@ def run_CASCADE(dff_path, model_name, pb):
 
     warnings.filterwarnings('ignore')
 
-    total_array_size = traces.itemsize * traces.size * 64 / 1e9
-
-    # If the expected array size is too large for the Colab Notebook, split up for processing
-    if total_array_size < 10:
-        spike_prob = cascade.predict(model_name, traces)
-        pb.setValue(10)
+    if use_cache:
+        cache = ResultCache()
+        key = cache.key(traces, model_name, threshold=0, padding=np.nan, discrete_seed=0, backend=selected)
+        cached = cache.get(key)
+        if cached is not None:
+            print('Using cached CASCADE results for this recording and model.')
+            pb.setValue(10)
+            spike_prob, discrete_approximation, spike_time_estimates = cached
+            write_spike_results(dff_path, spike_prob, spike_time_estimates)
+            return
+
+    # the prediction of a time point only depends on its input window (no thresholding
+    # across time points with the default threshold=0), so one window is enough overlap
+    cfg = model_cache.config(os.path.join(model_name, 'config.yaml'))
+    chunks = plan_chunks(traces.shape, memory_budget(budget), halo=cfg['windowsize'])
+
+    if len(chunks) == 1:
+        spike_prob = cascade.predict(model_name, traces, fuse_ensemble=True, backend=selected)
 
     # Will only be used for large input arrays (long recordings or many neurons)
     else:
 
-        print("Split analysis into chunks in order to fit into memory.")
+        print("Split analysis into {} chunks in order to fit into memory.".format(len(chunks)))
 
         # pre-allocate array for results
         spike_prob = np.zeros((traces.shape))
-        # nb of neurons and nb of chuncks
-        nb_neurons = traces.shape[0]
-        nb_chunks = np.int(np.ceil(total_array_size / 10))
+        noise_levels = dict()
 
-        chunks = np.array_split(range(nb_neurons), nb_chunks)
         # infer spike rates independently for each chunk
-        for part_array in range(nb_chunks):
-            pb.setValue(pb.Value+1)
-            spike_prob[chunks[part_array], :] = cascade.predict(model_name, traces[chunks[part_array], :])
+        for i, (neurons, (start, stop), (core_start, core_stop)) in enumerate(chunks):
+            pb.setValue(1 + 8 * i // len(chunks))
+
+            # noise levels (and therefore the model) are taken from the complete traces
+            if neurons.start not in noise_levels:
+                noise_levels[neurons.start] = calculate_noise_levels(traces[neurons, :], cfg['sampling_rate'])
+
+            prediction = cascade.predict(model_name, traces[neurons, start:stop],
+                                         trace_noise_levels=noise_levels[neurons.start], fuse_ensemble=True,
+                                         backend=selected)
+            spike_prob[neurons, core_start:core_stop] = prediction[:, core_start - start:core_stop - start]
+
+    pb.setValue(10)
 
-    discrete_approximation, spike_time_estimates = infer_discrete_spikes(spike_prob, model_name)
+    discrete_approximation, spike_time_estimates = infer_discrete_spikes(spike_prob, model_name, processes=None, seed=0)
+
+    if use_cache:
+        cache.put(key, spike_prob, discrete_approximation, spike_time_estimates)
+
+    write_spike_results(dff_path, spike_prob, spike_time_estimates)
+
+
+def write_spike_results(dff_path, spike_prob, spike_time_estimates):
+    """Write spike probabilities and spike times next to the dF/F file"""
 
     folder = os.path.dirname(dff_path)
+    if is_binary(dff_path):
+        # spike probabilities stay in the binary format of the dF/F file,
+        # the spike times differ in number per neuron and go to a .csv
+        name, ext = os.path.splitext(os.path.basename(dff_path))
+        pd.DataFrame(spike_time_estimates).to_csv(os.path.join(folder, 'discrete_spikes_' + name + '.csv'))
+        write_traces(os.path.join(folder, 'spike_probs_' + name + ext), spike_prob, rois=read_rois(dff_path))
+        return
+
     save_path = os.path.join(folder, 'discrete_spikes_' + os.path.basename(dff_path))
     pd.DataFrame(spike_time_estimates).to_csv(save_path)
 
@@ -1,14 +1,70 @@
-import pandas as pd
+import os
 import numpy as np
+import pandas as pd
 from functools import partial
-from scipy.ndimage.filters import median_filter
+from numpy.lib.stride_tricks import as_strided
+from scipy.ndimage.filters import median_filter, percentile_filter
 from math import floor, ceil
+from multiprocessing import Pool
+from .store import read_traces, read_rois, write_traces, derived_path, rois_from_shapes
 
 # Partial for simplifying repeat median filter calls
 medfilt = partial(median_filter, mode='constant')
 
 
-def noise_std(x: np.ndarray, filter_length: int = 31) -> float:
+def rolling_quantile(x: np.ndarray, window: int, quantile: float = 0.5) -> np.ndarray:
+    """Rolling quantile filter with the same output and 'constant' (zero)
+    edge handling as `medfilt`/`percentile_filter`, computed by the rolling
+    window of pandas for all ROIs in one call. pandas keeps every window in
+    a sorted skiplist (compiled, O(T log w) per ROI), which is much faster
+    than scipy versions that select the quantile of every window separately
+    (O(T w)). Newer scipy versions have a fast 1d filter themselves and are
+    faster than this engine.
+    Parameters
+    ----------
+    x: np.ndarray
+        1d array, or 2d array (ROIs x T) filtered along the time axis
+    window: int
+        Length of the rolling window
+    quantile: float (default=0.5)
+        Quantile of the window to return, 0.5 is the median.
+    Returns
+    -------
+    np.ndarray:
+        The filtered signal, same shape and dtype as `x`.
+    """
+    x = np.asarray(x)
+    if x.size == 0 or window == 1 or np.isnan(x).any():
+        # pandas skips NaNs instead of sorting them last like scipy
+        size = (1,) * (x.ndim - 1) + (window,)
+        return percentile_filter(x, quantile * 100, size, mode='constant')
+
+    rows = x.reshape(-1, x.shape[-1])
+    half = window // 2
+    padded = np.concatenate([np.zeros((len(rows), half), dtype=x.dtype), rows,
+                             np.zeros((len(rows), window - half - 1), dtype=x.dtype)], axis=1)
+    rolling = pd.DataFrame(padded.T).rolling(window)
+    if quantile == 0.5 and window % 2:
+        filtered = rolling.median()
+    else:
+        # the element of rank int(window * quantile), as selected by percentile_filter
+        rank = window - 1 if quantile >= 1 else int(window * quantile)
+        filtered = rolling.quantile(rank / (window - 1), interpolation='nearest')
+    return filtered.to_numpy()[window - 1:].T.reshape(x.shape).astype(x.dtype, copy=False)
+
+
+def rolling_median(x: np.ndarray, window: int) -> np.ndarray:
+    """Rolling median, see `rolling_quantile`."""
+    return rolling_quantile(x, window, 0.5)
+
+
+# Median filters selectable by the `filter_engine` arguments: "scipy" keeps
+# scipy.ndimage, "rolling" (pandas) is faster for long windows with older
+# scipy versions, which select the median of every window separately
+MEDIAN_FILTERS = {"scipy": medfilt, "rolling": rolling_median}
+
+
+def noise_std(x: np.ndarray, filter_length: int = 31, filter_engine: str = "scipy") -> float:
     """Compute a robust estimation of the standard deviation of the
     noise in a signal `x`. The noise is left after subtracting
     a rolling median filter value from the signal. Outliers are removed
@@ -20,6 +76,8 @@ def noise_std(x: np.ndarray, filter_length: int = 31) -> float:
     filter_length: int (default=31)
         Length of the median filter to compute a rolling baseline,
         which is subtracted from the signal `x`. Must be an odd number.
+    filter_engine: str (default="scipy")
+        Median filter implementation, a key of `MEDIAN_FILTERS`.
     Returns
     -------
     float:
@@ -28,7 +86,11 @@ def noise_std(x: np.ndarray, filter_length: int = 31) -> float:
     """
     if any(np.isnan(x)):
         return np.NaN
-    noise = x - medfilt(x, filter_length)
+    noise = x - MEDIAN_FILTERS[filter_engine](x, filter_length)
+    return _robust_noise_std(noise)
+
+
+def _robust_noise_std(noise: np.ndarray) -> float:
     # first pass removing positive outlier peaks
 
     # (method is fragile if possibly have 0 as min)
@@ -57,9 +119,166 @@ def robust_std(x: np.ndarray) -> float:
     mad = np.median(np.abs(x - np.median(x)))
     return 1.4826*mad
 
+def _exact_baseline_at(x: np.ndarray, filter_length: int, positions: np.ndarray) -> np.ndarray:
+    # the value of `medfilt(x, filter_length)` at a few positions only
+    padded = np.concatenate([np.zeros(filter_length // 2), x, np.zeros(filter_length - filter_length // 2 - 1)])
+    rank = filter_length // 2
+    return np.array([np.partition(padded[i:i + filter_length], rank)[rank] for i in positions])
+
+
+# number of quantiles that represent a bin of frames in `decimated_baseline`
+SKETCH_QUANTILES = 7
+
+
+def _sketch_baseline(x: np.ndarray, filter_length: int, factor: int, filt) -> np.ndarray:
+    # median filter on SKETCH_QUANTILES quantiles of every bin of `factor`
+    # frames, interpolated back to every frame; unlike the median of bin
+    # medians, this does not shift the baseline of skewed (spiking) traces
+    n_full = len(x) // factor * factor
+    ranks = ((np.arange(SKETCH_QUANTILES) + 0.5) * factor / SKETCH_QUANTILES).astype(int)
+    sketch = np.sort(x[:n_full].reshape(-1, factor), axis=1)[:, ranks]
+    centers = np.arange(n_full // factor) * factor + (factor - 1) / 2
+    if n_full < len(x):
+        tail = np.sort(x[n_full:])
+        ranks = ((np.arange(SKETCH_QUANTILES) + 0.5) * len(tail) / SKETCH_QUANTILES).astype(int)
+        sketch = np.vstack([sketch, tail[ranks]])
+        centers = np.append(centers, (n_full + len(x) - 1) / 2)
+
+    # the reduced window has to stay odd, like the exact one
+    reduced_length = max(1, int(round(filter_length / factor)) // 2 * 2 + 1) * SKETCH_QUANTILES
+    reduced = filt(sketch.ravel(), reduced_length)[np.arange(len(sketch)) * SKETCH_QUANTILES
+                                                   + SKETCH_QUANTILES // 2]
+    return np.interp(np.arange(len(x)), centers, reduced).astype(x.dtype)
+
+
+def _proven_within(padded: np.ndarray, filter_length: int, baseline: np.ndarray, max_error: float,
+                   starts: np.ndarray, block: int) -> np.ndarray:
+    # (len(starts) x block) mask of the frames `start + i` whose exact median
+    # is proven to lie within `max_error` of `baseline`. The median of a
+    # window is at most v if at least rank + 1 of its values are <= v, and at
+    # least v if at most rank values are < v; both are counted for all
+    # windows of a block at once with one threshold per block
+    rank = filter_length // 2
+    segment = filter_length + block - 1
+    frames = np.minimum(starts[:, None] + np.arange(block), len(baseline) - 1)
+    upper = (baseline[frames] + max_error).min(axis=1)
+    lower = (baseline[frames] - max_error).max(axis=1)
+
+    # frame t has the window padded[t:t + filter_length]
+    windows = as_strided(padded, shape=(len(padded) - segment + 1, segment), strides=padded.strides * 2)
+    proven = np.empty((len(starts), block), dtype=bool)
+    step = max(1, 2 ** 22 // segment)
+    for first in range(0, len(starts), step):
+        rows = slice(first, first + step)
+        segments = windows[starts[rows]]
+        counts = np.zeros((len(segments), segment + 1), dtype=np.int32)
+        np.cumsum(segments <= upper[rows, None], axis=1, out=counts[:, 1:])
+        proven[rows] = counts[:, filter_length:filter_length + block] - counts[:, :block] >= rank + 1
+        np.cumsum(segments < lower[rows, None], axis=1, out=counts[:, 1:])
+        proven[rows] &= counts[:, filter_length:filter_length + block] - counts[:, :block] <= rank
+    return proven
+
+
+def _unproven_frames(x: np.ndarray, filter_length: int, baseline: np.ndarray, max_error: float,
+                     min_block: int, max_frames: int) -> np.ndarray:
+    # frames between half a window from either end for which `_proven_within`
+    # fails. Blocks start at a quarter window and failing blocks are checked
+    # again in quarters, down to `min_block` frames, as the single threshold
+    # of a block is looser the more the baseline changes within it. Returns
+    # None as soon as the failing blocks of the first pass, or the frames
+    # left at the end, are more than `max_frames`
+    half = filter_length // 2
+    stop = len(x) - half
+    padded = np.concatenate([np.zeros(half, dtype=x.dtype), x, np.zeros(filter_length + half, dtype=x.dtype)])
+
+    block = max(filter_length // 4, min_block)
+    starts = np.arange(half, stop, block)
+    while True:
+        proven = _proven_within(padded, filter_length, baseline, max_error, starts, block)
+        proven |= starts[:, None] + np.arange(block) >= stop
+        failed = ~proven.all(axis=1)
+        if block <= min_block or not failed.any():
+            frames = starts[:, None] + np.arange(block)
+            return frames[~proven] if np.sum(~proven) <= max_frames else None
+        if block == filter_length // 4 and np.sum(failed) * block > 4 * max_frames:
+            # refining that many blocks costs more than the exact filter
+            return None
+        sub_block = max(block // 4, min_block)
+        starts = (starts[failed][:, None] + np.arange(0, block, sub_block)).ravel()
+        block = sub_block
+
+
+def decimated_baseline(x: np.ndarray,
+                       filter_length: int,
+                       max_error: float,
+                       filter_engine: str = "scipy",
+                       factor: int = None
+                       ) -> np.ndarray:
+    """Approximate the long median filter baseline of `x` on a decimated
+    trace, with an error bound that holds at every frame. Every bin of
+    `factor` frames is reduced to a few of its quantiles, the median
+    filter runs on these with a correspondingly shorter window and the
+    result is linearly interpolated back to every frame. Counting the
+    values of every window below the bounds then proves for most frames
+    that the exact median is within `max_error`; the remaining frames, and
+    the frames within half a window of either end, where the zero padding
+    bends the baseline sharply, are filtered exactly. If the approximation
+    misses the bound at one of 64 sampled frames, or too many frames are
+    left unproven, the exact filter is returned instead.
+    This only pays off where the exact filter selects the median of every
+    window separately, which takes O(T w): scipy versions without a fast
+    1d rank filter, where 100k frames with w=5401 take ~11 s exactly and
+    ~2.3 s decimated (mostly the exactly filtered ends). A fast exact
+    filter (current scipy, ~0.015 s) is always faster than this mode.
+    Parameters
+    ----------
+    x: np.ndarray
+        1d array of the fluorescence trace
+    filter_length: int
+        Length of the exact median filter that is approximated.
+    max_error: float
+        Largest absolute difference to the exact baseline.
+    filter_engine: str (default="scipy")
+        Median filter implementation, a key of `MEDIAN_FILTERS`.
+    factor: int (default=None)
+        Decimation factor; by default the reduced window spans about 64
+        bins.
+    Returns
+    -------
+    np.ndarray:
+        The approximate baseline, same shape as `x`.
+    """
+    filt = MEDIAN_FILTERS[filter_engine]
+    if factor is None:
+        factor = filter_length // 64
+    half = filter_length // 2
+    if len(x) < 4 * filter_length or factor < 2:
+        return filt(x, filter_length)
+
+    baseline = _sketch_baseline(x, filter_length, factor, filt)
+
+    # cheap check first: where the approximation misses the bound at sampled
+    # frames, too many frames would be left for the proof to pay off
+    samples = np.linspace(half, len(x) - half - 1, 64).astype(int)
+    if np.any(np.abs(baseline[samples] - _exact_baseline_at(x, filter_length, samples)) > max_error):
+        return filt(x, filter_length)
+
+    baseline[:half] = filt(x[:2 * half], filter_length)[:half]
+    baseline[len(x) - half:] = filt(x[len(x) - 2 * half:], filter_length)[half:]
+
+    # repairing more than 1/64 of the frames one by one would take longer than the exact filter
+    unproven = _unproven_frames(x, filter_length, baseline, max_error, max(1, factor // 2), len(x) // 64)
+    if unproven is None:
+        return filt(x, filter_length)
+    baseline[unproven] = _exact_baseline_at(x, filter_length, unproven)
+    return baseline
+
+
 def compute_dff_trace(corrected_fluorescence_trace: np.ndarray,
                       long_filter_length: int,
-                      short_filter_length: int
+                      short_filter_length: int,
+                      filter_engine: str = "scipy",
+                      baseline_error: float = None
                       ):
     """
     Compute the "delta F over F" from the fluorescence trace.
@@ -79,6 +298,12 @@ def compute_dff_trace(corrected_fluorescence_trace: np.ndarray,
     short_filter_length: int (default=31)
         Length (in number of elements) for a short median filter used
         for short timescale detrending.
+    filter_engine: str (default="scipy")
+        Median filter implementation, a key of `MEDIAN_FILTERS`.
+    baseline_error: float (default=None)
+        If given, the baseline is approximated by `decimated_baseline`
+        with a maximum error of `baseline_error` times the estimated
+        noise of the trace, e.g. 0.1. None computes the exact baseline.
     Returns
     -------
     np.ndarray:
@@ -90,18 +315,20 @@ def compute_dff_trace(corrected_fluorescence_trace: np.ndarray,
         filter) was less than or equal to the estimated noise of the
         `corrected_fluorescence_trace`.
     """
-    sigma_f = noise_std(corrected_fluorescence_trace, short_filter_length)
+    filt = MEDIAN_FILTERS[filter_engine]
+    sigma_f = noise_std(corrected_fluorescence_trace, short_filter_length, filter_engine)
 
     # Long timescale median filter for baseline subtraction
-    baseline = medfilt(corrected_fluorescence_trace, long_filter_length)
+    baseline = _baseline(corrected_fluorescence_trace, long_filter_length, filter_engine,
+                         baseline_error, sigma_f)
     dff = ((corrected_fluorescence_trace - baseline)
            / np.maximum(baseline, sigma_f))
     num_small_baseline_frames = np.sum(baseline <= sigma_f)
 
-    sigma_dff = noise_std(dff, short_filter_length)
+    sigma_dff = noise_std(dff, short_filter_length, filter_engine)
 
     # Short timescale detrending
-    filtered_dff = medfilt(dff, short_filter_length)
+    filtered_dff = filt(dff, short_filter_length)
     # Constrain to 2.5x the estimated noise of dff
     filtered_dff = np.minimum(filtered_dff, 2.5*sigma_dff)
 
@@ -110,7 +337,102 @@ def compute_dff_trace(corrected_fluorescence_trace: np.ndarray,
     return detrended_dff, sigma_dff, num_small_baseline_frames
 
 
-def dff_calc(file, long_filter=6):
+def _baseline(x, filter_length, filter_engine, baseline_error, sigma_f):
+    if baseline_error is None or np.isnan(sigma_f):
+        return MEDIAN_FILTERS[filter_engine](x, filter_length)
+    return decimated_baseline(x, filter_length, baseline_error * sigma_f, filter_engine)
+
+
+def _filter_rows(x: np.ndarray, filter_length: int, filter_engine: str) -> np.ndarray:
+    # median filter of every row of `x` along the time axis; rows are
+    # filtered one by one, as scipy only uses its fast 1d path for 1d input
+    filt = MEDIAN_FILTERS[filter_engine]
+    return np.stack([filt(row, filter_length) for row in x]) if len(x) else x.copy()
+
+
+def _noise_stds(x: np.ndarray, filter_length: int, filter_engine: str) -> np.ndarray:
+    # `noise_std` of every row of `x`
+    noise = x - _filter_rows(x, filter_length, filter_engine)
+    sigmas = np.full(len(x), np.nan)
+    for i, row in enumerate(noise):
+        if not np.isnan(x[i]).any():
+            sigmas[i] = _robust_noise_std(row)
+    return sigmas
+
+
+def _compute_dff_block(traces, long_filter_length, short_filter_length, filter_engine, baseline_error=None):
+    sigma_f = _noise_stds(traces, short_filter_length, filter_engine)[:, None]
+
+    # Long timescale median filter for baseline subtraction
+    if baseline_error is None:
+        baseline = _filter_rows(traces, long_filter_length, filter_engine)
+    else:
+        baseline = np.stack([_baseline(row, long_filter_length, filter_engine, baseline_error, sigma[0])
+                             for row, sigma in zip(traces, sigma_f)]) if len(traces) else traces.copy()
+    dff = (traces - baseline) / np.maximum(baseline, sigma_f)
+    num_small_baseline_frames = np.sum(baseline <= sigma_f, axis=1)
+
+    sigma_dff = _noise_stds(dff, short_filter_length, filter_engine)
+
+    # Short timescale detrending, constrained to 2.5x the estimated noise of dff
+    filtered_dff = _filter_rows(dff, short_filter_length, filter_engine)
+    filtered_dff = np.minimum(filtered_dff, 2.5*sigma_dff[:, None])
+
+    return dff - filtered_dff, sigma_dff, num_small_baseline_frames
+
+
+def compute_dff_traces(traces: np.ndarray,
+                       long_filter_length: int,
+                       short_filter_length: int = 101,
+                       filter_engine: str = "scipy",
+                       processes: int = 1,
+                       baseline_error: float = None
+                       ):
+    """
+    Compute the "delta F over F" of all ROIs at once. Same computation
+    as `compute_dff_trace`, but the median filters run over the whole
+    (ROIs x T) array along the time axis, optionally split across a
+    process pool.
+    Parameters
+    ----------
+    traces: np.ndarray
+        2d array (ROIs x T) of fluorescence traces, e.g. float32
+    long_filter_length: int
+        Length of the long median filter for the rolling baseline.
+        Must be an odd number.
+    short_filter_length: int (default=101)
+        Length of the short median filter for detrending.
+    filter_engine: str (default="scipy")
+        Median filter implementation, a key of `MEDIAN_FILTERS`.
+    processes: int (default=1)
+        Number of worker processes, None for all CPUs. With 1 the
+        computation runs in this process.
+    baseline_error: float (default=None)
+        Approximate the baselines with this error bound, see
+        `compute_dff_trace`.
+    Returns
+    -------
+    np.ndarray:
+        The detrended dff traces (ROIs x T), dtype of `traces`
+    np.ndarray:
+        The estimated standard deviation of the noise of every dff trace
+    np.ndarray:
+        Number of frames per ROI where the baseline was less than or equal
+        to the estimated noise of its trace.
+    """
+    traces = np.asarray(traces)
+    args = (long_filter_length, short_filter_length, filter_engine, baseline_error)
+    if processes == 1 or len(traces) < 2:
+        return _compute_dff_block(traces, *args)
+
+    blocks = np.array_split(traces, min(len(traces), (processes or os.cpu_count() or 1) * 4))
+    with Pool(processes) as pool:
+        results = pool.starmap(_compute_dff_block, [(block,) + args for block in blocks])
+    dff, sigma_dff, num_small_baseline_frames = zip(*results)
+    return np.concatenate(dff), np.concatenate(sigma_dff), np.concatenate(num_small_baseline_frames)
+
+
+def odd_filter_length(long_filter):
     # long_filter must be an odd integer number --> adjustment
     if int(long_filter) % 2 == 0:
         if floor(long_filter) % 2 == 0:
@@ -119,21 +441,34 @@ def dff_calc(file, long_filter=6):
             long_filter = floor(long_filter)
     else:
         long_filter = int(long_filter)
+    return long_filter
 
-    traces=pd.read_csv(file, sep="\t", header=None).T.to_numpy()
 
-    traces_mod = []
-    for trace in traces:
+def add_dff_qa(rois, sigma_dff, num_small_baseline_frames):
+    """ROI metadata with the QA values of `compute_dff_traces` added,
+    as they are kept with binary trace files."""
+    rois = [dict(roi) for roi in rois] if rois else rois_from_shapes([{}] * len(sigma_dff))
+    for roi, sigma, num_small in zip(rois, sigma_dff, num_small_baseline_frames):
+        roi["sigma_dff"] = float(sigma)
+        roi["num_small_baseline_frames"] = int(num_small)
+    return rois
 
-        detrended_dff, sigma_dff, num_small_baseline_frames = compute_dff_trace(trace,
-                                                                                long_filter_length=long_filter,
-                                                                                short_filter_length=101)
 
-        traces_mod.append(detrended_dff)
-    if file.endswith(".txt"):
-        pd.DataFrame(traces_mod).T.to_csv(file.replace(".txt", "_df_f.tsv"), sep="\t", header=None, index=False)
+def dff_calc(file, long_filter=6, filter_engine="scipy", processes=None, baseline_error=None):
+    long_filter = odd_filter_length(long_filter)
 
-    elif file.endswith(".tsv"):
-        pd.DataFrame(traces_mod).T.to_csv(file.replace(".tsv", "_df_f.tsv"), sep="\t", header=None, index=False)
-    else:
-        print("wrong file format")
\ No newline at end of file
+    traces = read_traces(file)
+
+    traces_mod, sigma_dff, num_small_baseline_frames = compute_dff_traces(traces,
+                                                                         long_filter_length=long_filter,
+                                                                         short_filter_length=101,
+                                                                         filter_engine=filter_engine,
+                                                                         processes=processes,
+                                                                         baseline_error=baseline_error)
+
+    rois = add_dff_qa(read_rois(file), sigma_dff, num_small_baseline_frames)
+
+    # binary trace files keep their format, text files are written as .tsv
+    write_traces(derived_path(file, "_df_f"), traces_mod, rois=rois)
+
+    return sigma_dff, num_small_baseline_frames
@@ -0,0 +1,63 @@
+import numpy as np
+from . import tracemanager
+from .dff import compute_dff_traces, odd_filter_length, add_dff_qa
+from .store import read_traces, read_rois, write_traces
+
+# Trace processing as a chain of in-memory stages. Every stage takes and
+# returns a pair (traces, rois): an array of shape (ROIs x frames) and the
+# ROI metadata list (see store.rois_from_shapes), so the output of one stage
+# is handed to the next without writing and parsing files in between.
+# Sinks write their input and pass it on unchanged; put them where an
+# output is wanted, e.g. after extraction and at the end:
+#
+#   run_pipeline(extraction(stack, compiled, rois),
+#                sink("traces.tsv"), dff_stage(5401), sink("traces_df_f.tsv"))
+
+
+def extraction(source, compiled_rois, rois, **options):
+    """Source stage: traces of a recording, see tracemanager.extractTraces
+    for the options. Returns None when the extraction was cancelled."""
+    traces = tracemanager.extractTraces(source, compiled_rois, **options)
+    if traces is None:
+        return None
+    return np.asarray(traces).T, rois
+
+
+def load(path):
+    """Source stage: traces and ROI metadata of a trace file."""
+    return read_traces(path), read_rois(path)
+
+
+def dff_stage(long_filter, short_filter=101, **options):
+    """Stage computing the dF/F of all ROIs, see dff.compute_dff_traces for
+    the options. The QA values are added to the ROI metadata."""
+    long_filter = odd_filter_length(long_filter)
+
+    def stage(data):
+        traces, rois = data
+        dff, sigma_dff, num_small_baseline_frames = compute_dff_traces(traces, long_filter, short_filter,
+                                                                       **options)
+        return dff, add_dff_qa(rois, sigma_dff, num_small_baseline_frames)
+
+    return stage
+
+
+def sink(path, **options):
+    """Stage writing its input to `path`, see store.write_traces."""
+
+    def stage(data):
+        traces, rois = data
+        write_traces(path, traces, rois=rois, **options)
+        return data
+
+    return stage
+
+
+def run_pipeline(data, *stages):
+    """Run `data` through `stages` in order and return the result; stops
+    early if a stage returns None."""
+    for stage in stages:
+        if data is None:
+            break
+        data = stage(data)
+    return data
@@ -0,0 +1,120 @@
+import os.path as osp
+import json
+import numpy as np
+import pandas as pd
+
+# Trace files store one row per frame and one column per ROI, like the TSV
+# files written so far. Binary stores keep the values as float32:
+#   .h5 / .hdf5   chunked, optionally compressed HDF5 (needs h5py)
+#   .npy          plain array that can be memory-mapped, ROI metadata is
+#                 kept in a .rois.json file next to it
+#   .tsv / .txt   tab separated text, for export
+BINARY_FORMATS = (".h5", ".hdf5", ".npy")
+TEXT_FORMATS = (".tsv", ".txt")
+
+
+def is_binary(path):
+    return osp.splitext(path)[1].lower() in BINARY_FORMATS
+
+
+def _rois_path(path):
+    return osp.splitext(path)[0] + ".rois.json"
+
+
+def _h5py():
+    try:
+        import h5py
+    except ModuleNotFoundError:
+        raise ModuleNotFoundError('The package "h5py" is needed for .h5 trace files. '
+                                  'Please install it with "pip install h5py" or use .npy files.')
+    return h5py
+
+
+def rois_from_shapes(shapes, indices=None):
+    """ROI metadata for the shapes of a label file: label, score, the index
+    of the shape in the label file and its polygon."""
+    if indices is None:
+        indices = range(len(shapes))
+    return [{"index": int(i), "label": shape.get("label"), "score": shape.get("score"),
+             "points": shape.get("points")} for i, shape in zip(indices, shapes)]
+
+
+def write_traces(path, traces, rois=None, compression="gzip"):
+    """Write traces of shape (ROIs x frames) to `path`.
+    Parameters
+    ----------
+    path: str
+        Target file; the extension selects the format.
+    traces: np.ndarray
+        2d array of shape (ROIs x frames)
+    rois: list of dict (default=None)
+        Metadata for every ROI, see `rois_from_shapes`. Not stored in text
+        files.
+    compression: str (default="gzip")
+        Compression filter of HDF5 files, None to disable.
+    """
+    ext = osp.splitext(path)[1].lower()
+    traces = np.asarray(traces)
+
+    if ext in (".h5", ".hdf5"):
+        h5py = _h5py()
+        with h5py.File(path, "w") as f:
+            f.create_dataset("traces", data=traces.T.astype(np.float32),
+                             chunks=True, compression=compression)
+            if rois is not None:
+                f.create_dataset("rois", data=json.dumps(rois))
+    elif ext == ".npy":
+        np.save(path, np.ascontiguousarray(traces.T, dtype=np.float32))
+        if rois is not None:
+            write_rois(path, rois)
+    elif ext in TEXT_FORMATS:
+        pd.DataFrame(traces).T.to_csv(path, sep="\t", header=None, index=False)
+    else:
+        raise ValueError("Unsupported trace file format: {}".format(path))
+
+
+def write_rois(path, rois):
+    """Write ROI metadata for a .npy trace file."""
+    with open(_rois_path(path), "w") as f:
+        json.dump(rois, f)
+
+
+def read_traces(path):
+    """Read a trace file as an array of shape (ROIs x frames).
+    .npy files are memory-mapped, so only the parts used are read.
+    """
+    ext = osp.splitext(path)[1].lower()
+
+    if ext in (".h5", ".hdf5"):
+        h5py = _h5py()
+        with h5py.File(path, "r") as f:
+            return f["traces"][()].T
+    elif ext == ".npy":
+        return np.load(path, mmap_mode="r").T
+    elif ext in TEXT_FORMATS:
+        return pd.read_csv(path, sep="\t", header=None).T.to_numpy()
+    raise ValueError("Unsupported trace file format: {}".format(path))
+
+
+def read_rois(path):
+    """Read the ROI metadata of a trace file, None if there is none."""
+    ext = osp.splitext(path)[1].lower()
+
+    if ext in (".h5", ".hdf5"):
+        h5py = _h5py()
+        with h5py.File(path, "r") as f:
+            if "rois" in f:
+                return json.loads(f["rois"][()])
+    elif ext == ".npy" and osp.exists(_rois_path(path)):
+        with open(_rois_path(path)) as f:
+            return json.load(f)
+    return None
+
+
+def derived_path(path, suffix):
+    """Name of a file derived from the trace file `path`, e.g. "_df_f".
+    Text files keep writing .tsv files, binary files keep their format."""
+    root, ext = osp.splitext(path)
+    if ext.lower() == ".txt":
+        ext = ".tsv"
+    return root + suffix + ext
@@ -3,8 +3,11 @@ import numpy as np
 from PIL import Image
 import json
 import sys
-from ..utils import shape_to_mask
+import hashlib
+from scipy import sparse
+from ..utils import shape_to_mask, shapes_to_label
 import tifffile as tfile
+from multiprocessing import Pool, RawArray, freeze_support
 
 # Function to convert an image to a numpy array
 def image2array(image_path):
@@ -12,10 +15,132 @@ def image2array(image_path):
     imarray = np.array(im)
     return imarray
 
-# Function to calculate traces for an image using masks
-def tracesForImage(imagePath, masks):
+# Function to compile ROI masks into a sparse (ROIs x pixels) weight matrix.
+# Every row holds 1/area at the pixels of its ROI, so multiplying the matrix
+# with a flattened frame yields the mean intensity of all ROIs at once.
+def compileRoiMatrix(masks, imageShape=None):
+    indptr = [0]
+    indices = []
+    weights = []
+    for mask in masks:
+        mask = np.asarray(mask, dtype=bool)
+        if imageShape is None:
+            imageShape = mask.shape
+        pixels = np.flatnonzero(mask)
+        indices.append(pixels)
+        weights.append(np.full(len(pixels), 1.0 / max(len(pixels), 1), dtype=np.float32))
+        indptr.append(indptr[-1] + len(pixels))
+
+    if imageShape is None:
+        raise ValueError("imageShape is required when no masks are given")
+
+    nPixels = int(np.prod(imageShape[:2]))
+    if indices:
+        indices = np.concatenate(indices)
+        weights = np.concatenate(weights)
+    else:
+        indices = np.zeros(0, dtype=np.int64)
+        weights = np.zeros(0, dtype=np.float32)
+    return sparse.csr_matrix((weights, indices, np.asarray(indptr)), shape=(len(indptr) - 1, nPixels))
+
+# Function to calculate the traces of a block of frames (frames x H x W) with
+# a single sparse matrix product; returns an array of shape (frames x ROIs)
+def tracesForBlock(block, roiMatrix):
+    block = np.asarray(block)
+    frames = block.reshape(-1, roiMatrix.shape[1])
+    traces = np.asarray(roiMatrix.dot(frames.T), dtype=np.float32).T
+    # empty ROIs have no mean, as with the masked arrays
+    traces[:, np.diff(roiMatrix.indptr) == 0] = np.nan
+    return traces
+
+# Function to rasterize the shapes of a label file into boolean masks
+def shapeMasks(imageShape, shapes):
+    for shape in shapes:
+        yield shape_to_mask(imageShape, shape['points'], shape_type=None, line_width=1, point_size=1)
+
+
+class RoiLabels:
+    """ROIs rasterized into a single int32 label image.
+
+    Pixel values are ROI index + 1 (0 is background), so the ROI means of a
+    frame are one bincount over the frame divided by the pixel counts, no
+    matter how many ROIs there are. ROIs that overlap other ROIs cannot be
+    represented in one label image; their means come from a small sparse
+    matrix compiled by compileRoiMatrix instead.
+    """
+
+    def __init__(self, labels, counts, fallbackIndex, fallback):
+        self.labels = labels
+        self.counts = counts
+        self.fallbackIndex = fallbackIndex
+        self.fallback = fallback
+        self.shape = (len(counts), labels.size)
+
+
+# Function to compile the shapes of a label file into a RoiLabels object
+def compileLabelImage(imageShape, shapes):
+    imageShape = tuple(imageShape[:2])
+    n = len(shapes)
+    # every shape is its own instance; rasterizing in both orders tells the
+    # pixels covered by more than one ROI apart, as only there the last
+    # drawn ROI differs between the two passes
+    shapes = [dict(shape, group_id=i) for i, shape in enumerate(shapes)]
+    labelValues = {shape['label']: 1 for shape in shapes}
+    _, labels = shapes_to_label(imageShape, shapes, labelValues)
+    _, reverse = shapes_to_label(imageShape, shapes[::-1], labelValues)
+    overlap = labels != np.where(reverse > 0, n + 1 - reverse, 0)
+
+    fallbackIndex = []
+    if overlap.any():
+        for i, shape in enumerate(shapes):
+            points = np.asarray(shape['points'])
+            (x0, y0), (x1, y1) = np.floor(points.min(0)).astype(int), np.ceil(points.max(0)).astype(int) + 1
+            if overlap[max(y0, 0):max(y1, 0), max(x0, 0):max(x1, 0)].any():
+                fallbackIndex.append(i)
+    fallbackIndex = np.asarray(fallbackIndex, dtype=np.int64)
+    fallback = compileRoiMatrix(shapeMasks(imageShape, [shapes[i] for i in fallbackIndex]), imageShape=imageShape)
+
+    labels = labels.ravel().astype(np.int32)
+    counts = np.bincount(labels, minlength=n + 1)[1:]
+    return RoiLabels(labels, counts, fallbackIndex, fallback)
+
+# Function to calculate the traces of a block of frames (frames x H x W)
+# with a label image; returns an array of shape (frames x ROIs)
+def tracesForLabels(block, roiLabels):
+    frames = np.asarray(block).reshape(-1, roiLabels.labels.size)
+    traces = np.empty((len(frames), roiLabels.shape[0]), dtype=np.float32)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for i, frame in enumerate(frames):
+            sums = np.bincount(roiLabels.labels, weights=frame, minlength=roiLabels.shape[0] + 1)[1:]
+            traces[i] = sums / roiLabels.counts
+    if len(roiLabels.fallbackIndex):
+        traces[:, roiLabels.fallbackIndex] = tracesForBlock(frames, roiLabels.fallback)
+    return traces
+
+# Function to compile the shapes of a label file for one of the engines:
+# "sparse" (one sparse matrix product per block of frames) or "label" (one
+# bincount per frame, for dense FOVs with thousands of ROIs)
+def compileRois(imageShape, shapes, engine="sparse"):
+    if engine == "sparse":
+        return compileRoiMatrix(shapeMasks(imageShape, shapes), imageShape=imageShape)
+    elif engine == "label":
+        return compileLabelImage(imageShape, shapes)
+    raise ValueError("Unknown trace extraction engine: {}".format(engine))
+
+# Function to calculate the traces of a block of frames with ROIs compiled
+# by compileRois
+def tracesFor(block, rois):
+    if isinstance(rois, RoiLabels):
+        return tracesForLabels(block, rois)
+    return tracesForBlock(block, rois)
+
+# Function to calculate the trace of a single frame, either with a list of
+# boolean masks or with a matrix compiled by compileRoiMatrix
+def tracesForFrame(im, masks):
+    if sparse.issparse(masks):
+        return tracesForBlock(im, masks)[0]
+
     trace = np.zeros(len(masks))
-    im = image2array(imagePath)
     for x in range(0, len(masks)):
         roimask = np.invert(masks[x])
         a = np.ma.array(im, mask=roimask)
@@ -23,18 +148,190 @@ def tracesForImage(imagePath, masks):
 
     return trace
 
+# Function to calculate traces for an image using masks
+def tracesForImage(imagePath, masks):
+    return tracesForFrame(image2array(imagePath), masks)
+
 def tracesForSlice(stackPath, slice, masks):
-    trace = np.zeros(len(masks))
-    im = tfile.imread(stackPath, key=slice)
-    for x in range(0, len(masks)):
-        roimask = np.invert(masks[x])
-        a = np.ma.array(im, mask=roimask)
-        trace[x] = a.mean()
+    return tracesForFrame(tfile.imread(stackPath, key=slice), masks)
 
-    return trace
 
-from multiprocessing import Pool, freeze_support
-from itertools import repeat
+class TiffStackReader:
+    """Reads contiguous blocks of frames from a multipage TIFF stack.
+
+    The file is opened and its page table parsed only once. Uncompressed,
+    contiguous stacks are memory-mapped, so reading a block of frames is a
+    plain slice; compressed stacks fall back to decoding the requested pages.
+    """
+
+    def __init__(self, stackPath):
+        self.path = stackPath
+        self.tif = tfile.TiffFile(stackPath)
+        self.shape = (len(self.tif.pages),) + tuple(self.tif.pages[0].shape)
+        try:
+            self.data = tfile.memmap(stackPath, mode="r")
+        except ValueError:
+            # compressed or not stored contiguously, decode page by page
+            self.data = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, start, stop):
+        stop = min(stop, len(self))
+        if self.data is not None:
+            block = self.data[start:stop]
+        else:
+            block = self.tif.asarray(key=range(start, stop))
+        return np.asarray(block).reshape((stop - start,) + self.shape[1:])
+
+    def blocks(self, blockSize):
+        for start in range(0, len(self), blockSize):
+            yield start, self.read(start, start + blockSize)
+
+    def close(self):
+        self.data = None
+        self.tif.close()
+
+
+class ImageSeriesReader:
+    """Reads blocks of frames from a series of single-image files."""
+
+    def __init__(self, imagePaths):
+        self.paths = list(imagePaths)
+        self.shape = (len(self.paths),) + image2array(self.paths[0]).shape
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, start, stop):
+        return np.stack([image2array(path) for path in self.paths[start:stop]])
+
+    def blocks(self, blockSize):
+        for start in range(0, len(self), blockSize):
+            yield start, self.read(start, start + blockSize)
+
+    def close(self):
+        pass
+
+
+# Function to open a reader for a tiff stack path or a list of image paths
+def openReader(source):
+    if isinstance(source, str):
+        return TiffStackReader(source)
+    return ImageSeriesReader(source)
+
+# Function to split a recording of nFrames into (start, stop) blocks
+def frameBlocks(nFrames, blockSize=64):
+    return [(start, min(start + blockSize, nFrames)) for start in range(0, nFrames, blockSize)]
+
+# state of an extraction worker, set once per process by _initWorker
+_worker = {}
+
+def _initWorker(source, rois, output, shape):
+    _worker['reader'] = openReader(source)
+    _worker['rois'] = rois
+    if isinstance(output, str):
+        _worker['traces'] = np.load(output, mmap_mode='r+')
+    else:
+        _worker['traces'] = np.frombuffer(output, dtype=np.float32).reshape(shape)
+
+def _extractBlock(block):
+    start, stop = block
+    _worker['traces'][start:stop] = tracesFor(_worker['reader'].read(start, stop), _worker['rois'])
+    if isinstance(_worker['traces'], np.memmap):
+        # the block is only reported as done once it is on disk
+        _worker['traces'].flush()
+    return block
+
+# Function to fingerprint compiled ROIs, so a checkpoint is only resumed
+# with the ROIs it was started with
+def roiFingerprint(rois):
+    digest = hashlib.sha1()
+    if isinstance(rois, RoiLabels):
+        digest.update(rois.labels.tobytes())
+    else:
+        digest.update(rois.indptr.tobytes())
+        digest.update(rois.indices.tobytes())
+    return digest.hexdigest()
+
+def _writeCheckpoint(path, checkpoint):
+    with open(path + ".tmp", 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + ".tmp", path)
+
+# Function to open the on-disk trace array of a streaming extraction and
+# the blocks already done according to its checkpoint; anything that does
+# not match the current job starts over
+def _openCheckpoint(outPath, checkpoint):
+    checkpointPath = outPath + ".checkpoint"
+    if os.path.exists(outPath) and os.path.exists(checkpointPath):
+        with open(checkpointPath) as f:
+            previous = json.load(f)
+        if {k: v for k, v in previous.items() if k != 'done'} == checkpoint:
+            return set(map(tuple, previous['done']))
+    np.lib.format.open_memmap(outPath, mode='w+', dtype=np.float32, shape=tuple(checkpoint['shape'])).flush()
+    _writeCheckpoint(checkpointPath, dict(checkpoint, done=[]))
+    return set()
+
+# Function to extract the traces of a whole recording with a process pool.
+# The compiled ROIs and the reader are handed to every worker once,
+# and the workers write straight into a shared (frames x ROIs) float32
+# array, so only frame ranges are sent between the processes.
+#
+# With outPath, the traces are streamed into a .npy file instead, block by
+# block, and the finished blocks are recorded in outPath + ".checkpoint".
+# Running the same extraction again after a crash or cancel only computes
+# the missing blocks. Returns None when cancelled() turns true.
+def extractTraces(source, rois, blockSize=64, processes=None, progress=None, outPath=None, cancelled=None):
+    with openReader(source) as reader:
+        nFrames = len(reader)
+    shape = (nFrames, rois.shape[0])
+    blocks = frameBlocks(nFrames, blockSize)
+
+    if outPath is None:
+        output = RawArray('f', int(np.prod(shape)))
+        done = set()
+    else:
+        sourceId = source
+        if not isinstance(source, str):
+            sourceId = hashlib.sha1("\n".join(source).encode()).hexdigest()
+        checkpoint = {'source': sourceId, 'shape': list(shape), 'blockSize': blockSize,
+                      'rois': roiFingerprint(rois)}
+        output = outPath
+        done = _openCheckpoint(outPath, checkpoint)
+        blocks = [block for block in blocks if block not in done]
+
+    nDone = sum(stop - start for start, stop in done)
+    with Pool(processes, initializer=_initWorker, initargs=(source, rois, output, shape)) as pool:
+        for block in pool.imap_unordered(_extractBlock, blocks):
+            nDone += block[1] - block[0]
+            if outPath is not None:
+                done.add(block)
+                _writeCheckpoint(outPath + ".checkpoint", dict(checkpoint, done=sorted(done)))
+            if progress is not None:
+                progress(nDone, nFrames)
+            if cancelled is not None and cancelled():
+                pool.terminate()
+                return None
+
+    if outPath is None:
+        return np.frombuffer(output, dtype=np.float32).reshape(shape)
+    os.remove(outPath + ".checkpoint")
+    return np.load(outPath, mmap_mode='r')
+
 
 if __name__ == '__main__':
     freeze_support()